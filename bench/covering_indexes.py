@@ -0,0 +1,187 @@
+"""
+Бенчмарк покрывающих индексов expenses (EXPENSES_COVERING_INDEXES из main.py).
+
+Генерирует синтетическую таблицу expenses в отдельной схеме, снимает
+EXPLAIN (ANALYZE, BUFFERS) горячих запросов со старыми индексами, затем
+с покрывающими — и печатает планы и время рядом.
+
+    DATABASE_URL=postgres://... python bench/covering_indexes.py --rows 10000000
+
+Схема bench_covering удаляется в конце (--keep — оставить).
+"""
+import os
+import sys
+import time
+import argparse
+from datetime import timedelta
+
+import psycopg2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from main import EXPENSES_COVERING_INDEXES  # noqa: E402
+
+SCHEMA = "bench_covering"
+
+CHATS = 200
+USERS = 10000          # tg_user_id = g % USERS, chat_id = g % CHATS
+DAYS = 3 * 365
+
+# пользователь 1207 живёт в чате 1207 % 200 = 7
+CHAT_ID = 7
+USER_ID = 1207
+
+QUERIES = [
+    ("breakdown_main_sub month edge", """
+        SELECT main_category, sub_category, currency, COALESCE(SUM(amount), 0) AS spent
+        FROM expenses
+        WHERE chat_id=%(chat)s AND tg_user_id=%(user)s AND spent_date BETWEEN %(month_start)s AND %(day)s
+        GROUP BY main_category, sub_category, currency
+        ORDER BY spent DESC;
+    """),
+    ("match_expenses year", """
+        SELECT COUNT(*) AS n, MAX(id) AS max_id
+        FROM expenses
+        WHERE chat_id=%(chat)s AND tg_user_id=%(user)s
+          AND spent_date BETWEEN %(year_ago)s AND %(day)s;
+    """),
+    ("match_expenses year, main", """
+        SELECT COUNT(*) AS n, MAX(id) AS max_id
+        FROM expenses
+        WHERE chat_id=%(chat)s AND tg_user_id=%(user)s
+          AND spent_date BETWEEN %(year_ago)s AND %(day)s
+          AND main_category='main3';
+    """),
+    ("match_expenses year, main+sub", """
+        SELECT COUNT(*) AS n, MAX(id) AS max_id
+        FROM expenses
+        WHERE chat_id=%(chat)s AND tg_user_id=%(user)s
+          AND spent_date BETWEEN %(year_ago)s AND %(day)s
+          AND main_category='main3' AND sub_category='sub11';
+    """),
+]
+
+
+def populate(cur, rows: int):
+    cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE;")
+    cur.execute(f"CREATE SCHEMA {SCHEMA};")
+    cur.execute(f"SET search_path TO {SCHEMA};")
+    cur.execute("""
+        CREATE TABLE expenses (
+            id SERIAL PRIMARY KEY,
+            chat_id BIGINT NOT NULL,
+            tg_user_id BIGINT NOT NULL,
+            amount NUMERIC NOT NULL,
+            currency TEXT NOT NULL DEFAULT 'UZS',
+            category TEXT,
+            main_category TEXT,
+            sub_category TEXT,
+            note TEXT,
+            spent_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            spent_date DATE
+        );
+    """)
+    t0 = time.monotonic()
+    cur.execute("""
+        INSERT INTO expenses(chat_id, tg_user_id, amount, currency, main_category, sub_category, note, spent_at, spent_date)
+        SELECT g %% %(chats)s,
+               g %% %(users)s,
+               ((g * 7919) %% 200000)::numeric,
+               CASE WHEN g %% 20 = 0 THEN 'USD' ELSE 'UZS' END,
+               'main' || (g %% 8),
+               'sub' || (g %% 32),
+               'note ' || g,
+               ts,
+               ts::date
+        FROM generate_series(1, %(rows)s) g,
+             LATERAL (SELECT (CURRENT_DATE + TIME '12:00')
+                             - ((g * 7919) %% %(days)s) * INTERVAL '1 day'
+                             - (g %% 36000) * INTERVAL '1 second' AS ts) t;
+    """, {"rows": rows, "chats": CHATS, "users": USERS, "days": DAYS})
+    print(f"populated {rows} rows in {time.monotonic() - t0:.1f}s")
+
+    # индексы, которые были до покрывающих
+    cur.execute("CREATE INDEX idx_expenses_chat_user_date ON expenses (chat_id, tg_user_id, spent_date);")
+    cur.execute("CREATE INDEX idx_expenses_chat_user_time ON expenses (chat_id, tg_user_id, spent_at);")
+
+
+def vacuum(conn):
+    # index-only scan требует актуальной visibility map
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute("VACUUM ANALYZE expenses;")
+    conn.autocommit = False
+
+
+def explain_all(cur, params) -> dict:
+    out = {}
+    for name, sql in QUERIES:
+        cur.execute("EXPLAIN (ANALYZE, BUFFERS) " + sql, params)
+        plan = [r[0] for r in cur.fetchall()]
+        ms = next((line.split(":")[1].strip() for line in plan if line.startswith("Execution Time")), "?")
+        out[name] = (ms, plan)
+    return out
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rows", type=int, default=10_000_000)
+    ap.add_argument("--keep", action="store_true", help="не удалять схему bench_covering")
+    args = ap.parse_args()
+
+    dsn = os.getenv("DATABASE_URL", "").strip()
+    if not dsn:
+        raise SystemExit("DATABASE_URL is required")
+
+    conn = psycopg2.connect(dsn)
+    try:
+        with conn.cursor() as cur:
+            populate(cur, args.rows)
+        conn.commit()
+        vacuum(conn)
+
+        with conn.cursor() as cur:
+            cur.execute(f"SET search_path TO {SCHEMA};")
+            cur.execute("SELECT CURRENT_DATE AS d, date_trunc('month', CURRENT_DATE)::date AS ms;")
+            day, ms = cur.fetchone()
+            params = {
+                "chat": CHAT_ID, "user": USER_ID,
+                "day": day, "month_start": ms, "year_ago": day - timedelta(days=365),
+            }
+
+            before = explain_all(cur, params)
+        conn.commit()
+
+        # CREATE INDEX CONCURRENTLY — только вне транзакции
+        t0 = time.monotonic()
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute(f"SET search_path TO {SCHEMA};")
+            for _, ddl in EXPENSES_COVERING_INDEXES:
+                cur.execute(ddl)
+            cur.execute("DROP INDEX IF EXISTS idx_expenses_chat_user_date;")
+        conn.autocommit = False
+        print(f"covering indexes built in {time.monotonic() - t0:.1f}s")
+        vacuum(conn)
+
+        with conn.cursor() as cur:
+            cur.execute(f"SET search_path TO {SCHEMA};")
+            after = explain_all(cur, params)
+
+        for name, _ in QUERIES:
+            print("=" * 80)
+            print(f"{name}: before {before[name][0]}  ->  after {after[name][0]}")
+            print("-- before:")
+            print("\n".join(before[name][1]))
+            print("-- after:")
+            print("\n".join(after[name][1]))
+    finally:
+        if not args.keep:
+            conn.rollback()
+            with conn.cursor() as cur:
+                cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE;")
+            conn.commit()
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,25 @@
 import os
 import re
 import json
+import time
 import base64
+import asyncio
 import logging
+import threading
+import functools
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from decimal import Decimal
-from datetime import datetime, date, timedelta
+from datetime import datetime, date, timedelta, timezone, time as dtime
 from typing import Optional, Dict, Any, List, Tuple
 
 import httpx
 import psycopg2
+import psycopg2.pool
+import psycopg2.errors
+import psycopg2.extensions
 from psycopg2.extras import RealDictCursor
 
 from telegram import Update, MessageEntity
@@ -36,6 +47,13 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "").strip()
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4.1-mini").strip()
 OPENAI_VISION_MODEL = os.getenv("OPENAI_VISION_MODEL", "gpt-4.1-mini").strip()
 
+# HTTP-клиент к OpenAI: один на процесс, keep-alive пул, HTTP/2 если установлен пакет h2 (httpx[http2])
+OPENAI_HTTP2 = (os.getenv("OPENAI_HTTP2", "1").strip() != "0")
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "20"))
+OPENAI_MAX_KEEPALIVE = int(os.getenv("OPENAI_MAX_KEEPALIVE", "10"))
+OPENAI_KEEPALIVE_EXPIRY = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY", "90"))
+OPENAI_CONNECT_TIMEOUT = float(os.getenv("OPENAI_CONNECT_TIMEOUT", "5"))
+
 DEFAULT_CURRENCY = (os.getenv("DEFAULT_CURRENCY", "UZS") or "UZS").strip().upper()
 
 # Реагировать только на упоминание или reply (экономия токенов)
@@ -58,249 +76,1531 @@ RELEASE_NOTES = (os.getenv("RELEASE_NOTES", "") or "").strip()
 HISTORY_LIMIT = int(os.getenv("HISTORY_LIMIT", "12"))
 MAX_SUMMARY_CHARS = int(os.getenv("MAX_SUMMARY_CHARS", "900"))
 
+# Хранение истории диалога: последние N сообщений на (chat, user) и (опционально) не старше N дней
+CONVO_KEEP_MESSAGES = max(HISTORY_LIMIT, int(os.getenv("CONVO_KEEP_MESSAGES", "100")))
+CONVO_MAX_AGE_DAYS = int(os.getenv("CONVO_MAX_AGE_DAYS", "0"))
+CONVO_PRUNE_INTERVAL = int(os.getenv("CONVO_PRUNE_INTERVAL", "3600"))
+CONVO_PRUNE_BATCH = int(os.getenv("CONVO_PRUNE_BATCH", "10000"))
+
+# Движок текстовых запросов: json — планировщик + отдельный вызов для ответа; tools — function calling,
+# результаты действий возвращаются в тот же диалог (previous_response_id), без повторной отправки промпта
+PLAN_ENGINE = (os.getenv("PLAN_ENGINE", "json") or "json").strip().lower()
+
+# Простые сообщения о расходе ("кофе 12000", "такси 35к") разбирать локально, без вызова планировщика
+FAST_PATH = (os.getenv("FAST_PATH", "1").strip() != "0")
+
+# Сколько записей истории расходов отдавать за одну страницу
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "25"))
+
+# Сколько последних записей можно удалить одной командой /undo
+UNDO_MAX = int(os.getenv("UNDO_MAX", "20"))
+
+# known_chats.last_seen копится в памяти и пишется в БД одной пачкой раз в N секунд
+TOUCH_FLUSH_INTERVAL = int(os.getenv("TOUCH_FLUSH_INTERVAL", "30"))
+
 BOT_USERNAME_CACHE: Optional[str] = os.getenv("TELEGRAM_BOT_USERNAME", "").strip() or None
 
+# Пул соединений к Postgres
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+# соединение старше N секунд закрывается и открывается заново
+DB_CONN_MAX_LIFETIME = int(os.getenv("DB_CONN_MAX_LIFETIME", "1800"))
+# если соединение простаивало дольше N секунд — перед выдачей проверяем его SELECT 1
+DB_CONN_CHECK_IDLE = int(os.getenv("DB_CONN_CHECK_IDLE", "30"))
+
+# Фоновое заполнение старых строк: размер пачки и пауза между пачками
+BACKFILL_BATCH_SIZE = int(os.getenv("BACKFILL_BATCH_SIZE", "5000"))
+BACKFILL_PAUSE_S = float(os.getenv("BACKFILL_PAUSE_S", "0.1"))
+
+# Ночной пересчёт переносов на новый день (локальное время сервера, HH:MM)
+ROLLOVER_JOB_TIME = (os.getenv("ROLLOVER_JOB_TIME", "00:05") or "00:05").strip()
+# Пересчёт переносов после изменения прошлых дней: период (сек) и сколько ключей за транзакцию
+ROLLOVER_DIRTY_INTERVAL = int(os.getenv("ROLLOVER_DIRTY_INTERVAL", "60"))
+ROLLOVER_DIRTY_BATCH = int(os.getenv("ROLLOVER_DIRTY_BATCH", "500"))
+# ключ, пересчёт которого падает, откладывается в конец очереди; после N неудач — до следующего изменения
+ROLLOVER_DIRTY_MAX_ATTEMPTS = int(os.getenv("ROLLOVER_DIRTY_MAX_ATTEMPTS", "5"))
+
+# Секционирование expenses по месяцам spent_date (включается один раз, обратно не откатывается)
+EXPENSES_PARTITIONED = (os.getenv("EXPENSES_PARTITIONED", "0").strip() == "1")
+PARTITION_MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", "3"))
+
 
 # =========================
 # DB
 # =========================
 
+class DBPool:
+    """
+    Ограниченный пул psycopg2-соединений.
+    - не больше maxconn открытых соединений; при насыщении ждём до timeout секунд
+    - простаивавшие соединения проверяются перед выдачей (SELECT 1)
+    - соединения старше max_lifetime пересоздаются
+    - metrics() — счётчики для мониторинга насыщения
+    """
+
+    def __init__(self, dsn: str, minconn: int, maxconn: int, timeout: float,
+                 max_lifetime: int, check_idle: int):
+        self.dsn = dsn
+        self.minconn = max(0, minconn)
+        self.maxconn = max(1, maxconn)
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.check_idle = check_idle
+
+        self._cond = threading.Condition()
+        self._idle: List[Any] = []            # свободные соединения (LIFO)
+        self._born: Dict[int, float] = {}     # id(conn) -> время создания
+        self._last_used: Dict[int, float] = {}
+        self._size = 0                        # открыто всего (idle + in_use)
+        self._in_use = 0
+
+        self.stats = {
+            "acquired": 0,
+            "created": 0,
+            "closed": 0,
+            "recycled": 0,
+            "health_failures": 0,
+            "waits": 0,
+            "wait_seconds": 0.0,
+            "timeouts": 0,
+            "peak_in_use": 0,
+        }
+
+    def _connect(self):
+        conn = psycopg2.connect(
+            self.dsn,
+            sslmode="require",
+            cursor_factory=RealDictCursor,
+        )
+        now = time.monotonic()
+        # учёт — под блокировкой пула (Condition на RLock, из prefill берётся повторно)
+        with self._cond:
+            self._born[id(conn)] = now
+            self._last_used[id(conn)] = now
+            self.stats["created"] += 1
+        return conn
+
+    def _discard(self, conn):
+        self._born.pop(id(conn), None)
+        self._last_used.pop(id(conn), None)
+        try:
+            conn.close()
+        except Exception:
+            pass
+        self.stats["closed"] += 1
+
+    def _expired(self, conn, now: float) -> bool:
+        born = self._born.get(id(conn), now)
+        return bool(self.max_lifetime and now - born > self.max_lifetime)
+
+    def _needs_check(self, conn, now: float) -> bool:
+        return bool(conn.closed) or now - self._last_used.get(id(conn), now) >= self.check_idle
+
+    @staticmethod
+    def _ping(conn) -> bool:
+        # вызывается без блокировки пула: полуживой сокет может висеть до TCP-таймаута
+        if conn.closed:
+            return False
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1;")
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def prefill(self):
+        with self._cond:
+            while self._size < self.minconn:
+                self._idle.append(self._connect())
+                self._size += 1
+
+    def acquire(self):
+        deadline = time.monotonic() + self.timeout
+        waited_from = None
+        while True:
+            candidate = None
+            with self._cond:
+                while True:
+                    now = time.monotonic()
+                    while self._idle:
+                        conn = self._idle.pop()
+                        if self._expired(conn, now):
+                            self.stats["recycled"] += 1
+                            self._discard(conn)
+                            self._size -= 1
+                        elif self._needs_check(conn, now):
+                            # слот остаётся за нами; проверяем уже после выхода из-под блокировки
+                            candidate = conn
+                            break
+                        else:
+                            return self._checkout(conn, waited_from)
+                    if candidate is not None:
+                        break
+
+                    if self._size < self.maxconn:
+                        # резервируем слот, само соединение открываем без блокировки пула
+                        self._size += 1
+                        break
+
+                    if waited_from is None:
+                        waited_from = now
+                        self.stats["waits"] += 1
+                        logger.warning("DB pool saturated: %s/%s in use", self._in_use, self.maxconn)
+                    left = deadline - now
+                    if left <= 0:
+                        self.stats["timeouts"] += 1
+                        raise psycopg2.pool.PoolError(f"DB pool exhausted ({self.maxconn} connections)")
+                    self._cond.wait(left)
+
+            if candidate is None:
+                break
+            if self._ping(candidate):
+                with self._cond:
+                    return self._checkout(candidate, waited_from)
+            try:
+                candidate.close()
+            except Exception:
+                pass
+            with self._cond:
+                self.stats["health_failures"] += 1
+                self._discard(candidate)
+                self._size -= 1
+                self._cond.notify()
+
+        try:
+            conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            return self._checkout(conn, waited_from)
+
+    def _checkout(self, conn, waited_from: Optional[float]):
+        if waited_from is not None:
+            self.stats["wait_seconds"] += time.monotonic() - waited_from
+        self._in_use += 1
+        self.stats["acquired"] += 1
+        self.stats["peak_in_use"] = max(self.stats["peak_in_use"], self._in_use)
+        return conn
+
+    def release(self, conn):
+        broken = bool(conn.closed)
+        if not broken:
+            try:
+                # незакоммиченное не должно утечь в следующий запрос
+                if conn.status != psycopg2.extensions.STATUS_READY:
+                    conn.rollback()
+            except Exception:
+                broken = True
+
+        with self._cond:
+            self._in_use -= 1
+            now = time.monotonic()
+            if broken or self._expired(conn, now):
+                if not broken:
+                    self.stats["recycled"] += 1
+                self._discard(conn)
+                self._size -= 1
+            else:
+                self._last_used[id(conn)] = now
+                self._idle.append(conn)
+            self._cond.notify()
+
+    def close_all(self):
+        with self._cond:
+            while self._idle:
+                self._discard(self._idle.pop())
+                self._size -= 1
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._cond:
+            m = dict(self.stats)
+            m.update({
+                "size": self._size,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "max": self.maxconn,
+                "saturation": round(self._in_use / self.maxconn, 2),
+            })
+            m["wait_seconds"] = round(m["wait_seconds"], 3)
+            return m
+
+
+DB_POOL = DBPool(DATABASE_URL, DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT,
+                 DB_CONN_MAX_LIFETIME, DB_CONN_CHECK_IDLE)
+
+
+# Текущая единица работы (апдейт Telegram); через run_db попадает и в потоки DB_EXECUTOR
+_CURRENT_UOW: contextvars.ContextVar[Optional["UnitOfWork"]] = contextvars.ContextVar("current_uow", default=None)
+
+
+class _SharedConn:
+    """
+    Соединение единицы работы: commit() и rollback() хелперов — no-op.
+    Фиксирует транзакцию сама UnitOfWork; ошибка в хелпере пробрасывается, и UnitOfWork откатывает всё.
+    """
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def cursor(self, *args, **kwargs):
+        return self._conn.cursor(*args, **kwargs)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+class UnitOfWork:
+    """
+    Одно соединение и одна транзакция на обработку апдейта.
+    Все хелперы, вызванные через run_db внутри `async with UnitOfWork()`, работают в ней;
+    commit — один раз при выходе (rollback — при исключении).
+    Соединение берётся из пула лениво, при первом запросе.
+    checkpoint() фиксирует сделанное и отдаёт соединение в пул перед долгим ожиданием
+    (OpenAI, ответ в Telegram), чтобы не держать транзакцию открытой.
+    """
+
+    def __init__(self):
+        self.conn = None
+        self._lock = threading.Lock()
+        self._token = None
+        self._on_commit: List[Any] = []
+
+    def connection(self):
+        with self._lock:
+            if self.conn is None:
+                self.conn = DB_POOL.acquire()
+            return self.conn
+
+    def on_commit(self, fn):
+        """fn() вызовется после успешного commit; при rollback — отбрасывается."""
+        with self._lock:
+            self._on_commit.append(fn)
+
+    def _finish(self, commit: bool):
+        with self._lock:
+            conn, self.conn = self.conn, None
+            callbacks, self._on_commit = self._on_commit, []
+        if conn is None:
+            return
+        try:
+            if commit:
+                conn.commit()
+            else:
+                conn.rollback()
+                callbacks = []
+        finally:
+            DB_POOL.release(conn)
+        for fn in callbacks:
+            fn()
+
+    async def checkpoint(self):
+        if self.conn is not None:
+            await run_db(self._finish, True)
+
+    async def __aenter__(self):
+        self._token = _CURRENT_UOW.set(self)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        _CURRENT_UOW.reset(self._token)
+        if self.conn is not None:
+            await run_db(self._finish, exc_type is None)
+        return False
+
+
+def after_commit(fn):
+    """Выполнить fn() после фиксации сделанного: в UnitOfWork — после её commit, иначе сразу (db() уже закоммитил)."""
+    uow = _CURRENT_UOW.get()
+    if uow is not None:
+        uow.on_commit(fn)
+    else:
+        fn()
+
+
+@contextmanager
 def db():
-    return psycopg2.connect(
-        DATABASE_URL,
-        sslmode="require",
-        cursor_factory=RealDictCursor,
-    )
+    """
+    Соединение из пула на время блока with.
+    Успешный выход — commit, исключение — rollback; затем соединение возвращается в пул.
+    Внутри UnitOfWork — общее соединение апдейта без лишних запросов: commit и rollback делает сама UnitOfWork.
+    """
+    uow = _CURRENT_UOW.get()
+    if uow is not None:
+        yield _SharedConn(uow.connection())
+        return
 
+    conn = DB_POOL.acquire()
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+        raise
+    finally:
+        DB_POOL.release(conn)
 
-def init_db():
+
+# Блокирующий psycopg2 выполняется в отдельном пуле потоков, event loop не ждёт Postgres.
+# Потоков столько же, сколько соединений в пуле: больше параллельных запросов всё равно не будет.
+DB_EXECUTOR = ThreadPoolExecutor(max_workers=DB_POOL.maxconn, thread_name_prefix="db")
+
+
+async def run_db(fn, *args, **kwargs):
+    """
+    Выполнить синхронную DB-функцию в DB_EXECUTOR и дождаться результата.
+    contextvars копируются в поток (нужно для контекста текущего апдейта).
     """
-    Создаёт таблицы если их нет.
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()
+    call = functools.partial(ctx.run, fn, *args, **kwargs)
+    return await loop.run_in_executor(DB_EXECUTOR, call)
+
+
+# =========================
+# Schema migrations
+# =========================
+# Каждая миграция — (версия, название, функция(cur)). Применённая версия хранится
+# в bot_meta (k='schema_version'). Новые шаги добавляются только в конец списка.
+
+SCHEMA_VERSION_KEY = "schema_version"
+MIGRATION_LOCK_ID = 7410001  # pg_advisory_xact_lock: два инстанса не мигрируют одновременно
+
+
+def _migration_001_baseline(cur):
+    """
+    Исходная схема.
     Если таблицы уже есть со старой схемой — делает безопасные ALTER (без потери данных).
     """
-    with db() as conn, conn.cursor() as cur:
-        # --- служебные ---
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS known_chats (
-                chat_id BIGINT PRIMARY KEY,
-                first_seen TIMESTAMP NOT NULL DEFAULT NOW(),
-                last_seen TIMESTAMP NOT NULL DEFAULT NOW()
-            );
-        """)
+    # --- служебные ---
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS known_chats (
+            chat_id BIGINT PRIMARY KEY,
+            first_seen TIMESTAMP NOT NULL DEFAULT NOW(),
+            last_seen TIMESTAMP NOT NULL DEFAULT NOW()
+        );
+    """)
+
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS bot_meta (
+            k TEXT PRIMARY KEY,
+            v TEXT NOT NULL,
+            updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+        );
+    """)
+
+    # --- expenses ---
+    # Создаём базовую таблицу "как новая" (если её нет)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS expenses (
+            id SERIAL PRIMARY KEY,
+            chat_id BIGINT NOT NULL,
+            tg_user_id BIGINT NOT NULL,
+            amount NUMERIC NOT NULL,
+            currency TEXT NOT NULL DEFAULT 'UZS',
+            category TEXT,
+            main_category TEXT,
+            sub_category TEXT,
+            note TEXT,
+            spent_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            spent_date DATE
+        );
+    """)
+
+    # MIGRATION: если таблица была старой — гарантируем наличие нужных колонок
+    cur.execute("ALTER TABLE expenses ADD COLUMN IF NOT EXISTS chat_id BIGINT;")
+    cur.execute("ALTER TABLE expenses ADD COLUMN IF NOT EXISTS tg_user_id BIGINT;")
+    cur.execute("ALTER TABLE expenses ADD COLUMN IF NOT EXISTS amount NUMERIC;")
+    cur.execute("ALTER TABLE expenses ADD COLUMN IF NOT EXISTS currency TEXT;")
+    cur.execute("ALTER TABLE expenses ADD COLUMN IF NOT EXISTS category TEXT;")
+    cur.execute("ALTER TABLE expenses ADD COLUMN IF NOT EXISTS main_category TEXT;")
+    cur.execute("ALTER TABLE expenses ADD COLUMN IF NOT EXISTS sub_category TEXT;")
+    cur.execute("ALTER TABLE expenses ADD COLUMN IF NOT EXISTS note TEXT;")
+    cur.execute("ALTER TABLE expenses ADD COLUMN IF NOT EXISTS spent_at TIMESTAMP;")
+    cur.execute("ALTER TABLE expenses ADD COLUMN IF NOT EXISTS spent_date DATE;")
+
+    # заполнение старых строк (spent_at, spent_date, main/sub_category) делает
+    # фоновый run_backfills() пачками — здесь полных UPDATE по expenses нет
+
+    # Приводим обязательность (с осторожностью): только если данные уже заполнены
+    # chat_id / tg_user_id / amount / currency / spent_at / spent_date обязательны для новой логики
+    # Если у вас ранее могли быть NULL — их закрывает run_backfills().
+    cur.execute("ALTER TABLE expenses ALTER COLUMN currency SET DEFAULT 'UZS';")
+    cur.execute("ALTER TABLE expenses ALTER COLUMN spent_at SET DEFAULT NOW();")
+    cur.execute("ALTER TABLE expenses ALTER COLUMN spent_date SET DEFAULT CURRENT_DATE;")
+
+    # Индексы. (chat_id, tg_user_id, spent_date) покрывает idx_expenses_period_totals (build_expense_indexes)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_expenses_chat_user_time
+        ON expenses (chat_id, tg_user_id, spent_at);
+    """)
+
+    # --- budgets ---
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS budgets (
+            id SERIAL PRIMARY KEY,
+            chat_id BIGINT NOT NULL,
+            tg_user_id BIGINT NOT NULL,
+            category TEXT,
+            main_category TEXT,
+            currency TEXT NOT NULL DEFAULT 'UZS',
+            daily_limit NUMERIC,
+            monthly_limit NUMERIC,
+            created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+        );
+    """)
+
+    cur.execute("ALTER TABLE budgets ADD COLUMN IF NOT EXISTS chat_id BIGINT;")
+    cur.execute("ALTER TABLE budgets ADD COLUMN IF NOT EXISTS tg_user_id BIGINT;")
+    cur.execute("ALTER TABLE budgets ADD COLUMN IF NOT EXISTS category TEXT;")
+    cur.execute("ALTER TABLE budgets ADD COLUMN IF NOT EXISTS main_category TEXT;")
+    cur.execute("ALTER TABLE budgets ADD COLUMN IF NOT EXISTS currency TEXT;")
+    cur.execute("ALTER TABLE budgets ADD COLUMN IF NOT EXISTS daily_limit NUMERIC;")
+    cur.execute("ALTER TABLE budgets ADD COLUMN IF NOT EXISTS monthly_limit NUMERIC;")
+    cur.execute("ALTER TABLE budgets ADD COLUMN IF NOT EXISTS created_at TIMESTAMP;")
+    cur.execute("ALTER TABLE budgets ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP;")
+
+    cur.execute("""
+        UPDATE budgets
+        SET main_category = COALESCE(main_category, category)
+        WHERE main_category IS NULL;
+    """)
+    cur.execute("""
+        UPDATE budgets
+        SET main_category = 'other'
+        WHERE main_category IS NULL OR TRIM(main_category) = '';
+    """)
+    cur.execute("""
+        UPDATE budgets
+        SET currency = COALESCE(currency, 'UZS')
+        WHERE currency IS NULL OR TRIM(currency) = '';
+    """)
+
+    # уникальность бюджета на (chat,user,main_category,currency)
+    cur.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS budgets_unique
+        ON budgets (chat_id, tg_user_id, main_category, currency);
+    """)
+
+    # --- daily_overrides (для переносов) ---
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS daily_overrides (
+            id SERIAL PRIMARY KEY,
+            chat_id BIGINT NOT NULL,
+            tg_user_id BIGINT NOT NULL,
+            main_category TEXT NOT NULL,
+            currency TEXT NOT NULL,
+            day DATE NOT NULL,
+            effective_limit NUMERIC NOT NULL,
+            reason TEXT NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT NOW()
+        );
+    """)
+    cur.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS daily_overrides_unique
+        ON daily_overrides (chat_id, tg_user_id, main_category, currency, day);
+    """)
+
+    # --- память диалога (контекст) ---
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS convo_memory (
+            chat_id BIGINT NOT NULL,
+            tg_user_id BIGINT NOT NULL,
+            summary TEXT NOT NULL DEFAULT '',
+            updated_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            PRIMARY KEY(chat_id, tg_user_id)
+        );
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS convo_messages (
+            id SERIAL PRIMARY KEY,
+            chat_id BIGINT NOT NULL,
+            tg_user_id BIGINT NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT NOW()
+        );
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS convo_messages_idx
+        ON convo_messages (chat_id, tg_user_id, created_at DESC);
+    """)
+
+    # --- состояния (например подтверждение удаления) ---
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS user_states (
+            chat_id BIGINT NOT NULL,
+            tg_user_id BIGINT NOT NULL,
+            state_json TEXT NOT NULL,
+            updated_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            PRIMARY KEY(chat_id, tg_user_id)
+        );
+    """)
+
+
+# Покрывающие индексы под горячие запросы: все нужные колонки лежат в индексе,
+# Postgres отвечает index-only scan без чтения строк таблицы.
+# Покрывающие индексы expenses. INCLUDE — только то, что читают запросы (без note: свободный текст
+# без ограничения длины раздувает индекс и может не влезть в строку B-tree).
+# Строятся CONCURRENTLY вне транзакции миграций (build_expense_indexes), запись в expenses не блокируется.
+EXPENSES_COVERING_INDEXES: List[Tuple[str, str]] = [
+    # края периода в breakdown_main_sub, match/delete по периоду без категории
+    ("idx_expenses_period_totals", """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_expenses_period_totals
+        ON expenses (chat_id, tg_user_id, spent_date)
+        INCLUDE (main_category, sub_category, currency, amount, id);
+    """),
+    # match/delete по main_category / main_category+sub_category
+    ("idx_expenses_category_match", """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_expenses_category_match
+        ON expenses (chat_id, tg_user_id, main_category, sub_category, spent_date)
+        INCLUDE (id);
+    """),
+]
+
+# индекс из старых установок: его ключ — префикс idx_expenses_period_totals, удаляется после постройки замены
+EXPENSES_OBSOLETE_INDEXES = (
+    "idx_expenses_chat_user_date",
+)
 
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS bot_meta (
-                k TEXT PRIMARY KEY,
-                v TEXT NOT NULL,
-                updated_at TIMESTAMP NOT NULL DEFAULT NOW()
-            );
-        """)
 
-        # --- expenses ---
-        # Создаём базовую таблицу "как новая" (если её нет)
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS expenses (
-                id SERIAL PRIMARY KEY,
-                chat_id BIGINT NOT NULL,
-                tg_user_id BIGINT NOT NULL,
-                amount NUMERIC NOT NULL,
-                currency TEXT NOT NULL DEFAULT 'UZS',
-                category TEXT,
-                main_category TEXT,
-                sub_category TEXT,
-                note TEXT,
-                spent_at TIMESTAMP NOT NULL DEFAULT NOW(),
-                spent_date DATE
-            );
-        """)
+def _migration_002_noop(cur):
+    # номер версии занят; индексы expenses строит build_expense_indexes (CONCURRENTLY, вне транзакции миграции)
+    pass
 
-        # MIGRATION: если таблица была старой — гарантируем наличие нужных колонок
-        cur.execute("ALTER TABLE expenses ADD COLUMN IF NOT EXISTS chat_id BIGINT;")
-        cur.execute("ALTER TABLE expenses ADD COLUMN IF NOT EXISTS tg_user_id BIGINT;")
-        cur.execute("ALTER TABLE expenses ADD COLUMN IF NOT EXISTS amount NUMERIC;")
-        cur.execute("ALTER TABLE expenses ADD COLUMN IF NOT EXISTS currency TEXT;")
-        cur.execute("ALTER TABLE expenses ADD COLUMN IF NOT EXISTS category TEXT;")
-        cur.execute("ALTER TABLE expenses ADD COLUMN IF NOT EXISTS main_category TEXT;")
-        cur.execute("ALTER TABLE expenses ADD COLUMN IF NOT EXISTS sub_category TEXT;")
-        cur.execute("ALTER TABLE expenses ADD COLUMN IF NOT EXISTS note TEXT;")
-        cur.execute("ALTER TABLE expenses ADD COLUMN IF NOT EXISTS spent_at TIMESTAMP;")
-        cur.execute("ALTER TABLE expenses ADD COLUMN IF NOT EXISTS spent_date DATE;")
-
-        # заполняем spent_at если NULL
-        cur.execute("""
-            UPDATE expenses
-            SET spent_at = NOW()
-            WHERE spent_at IS NULL;
-        """)
 
-        # заполняем spent_date если NULL (из spent_at или today)
-        cur.execute("""
-            UPDATE expenses
-            SET spent_date = COALESCE(spent_date, (spent_at::date), CURRENT_DATE)
-            WHERE spent_date IS NULL;
-        """)
+def _migration_003_daily_totals(cur):
+    """
+    daily_totals — сумма расходов за день по (chat, user, main_category, currency).
+    Ведётся триггером на expenses в той же транзакции, что и запись/удаление расхода.
+    NULL в main_category/currency хранится как '' (такие строки не совпадают ни с одной категорией,
+    как и в запросе по expenses); строки без spent_date/chat_id/tg_user_id не учитываются.
+    """
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS daily_totals (
+            chat_id BIGINT NOT NULL,
+            tg_user_id BIGINT NOT NULL,
+            main_category TEXT NOT NULL,
+            currency TEXT NOT NULL,
+            spent_date DATE NOT NULL,
+            amount NUMERIC NOT NULL DEFAULT 0,
+            n INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (chat_id, tg_user_id, main_category, currency, spent_date)
+        );
+    """)
+    # итог за период без фильтра категории
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS daily_totals_by_date
+        ON daily_totals (chat_id, tg_user_id, spent_date)
+        INCLUDE (amount);
+    """)
+
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION expenses_daily_totals_trg() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        DECLARE
+            left_n INTEGER;
+        BEGIN
+            IF TG_OP IN ('DELETE', 'UPDATE')
+               AND OLD.spent_date IS NOT NULL AND OLD.chat_id IS NOT NULL AND OLD.tg_user_id IS NOT NULL THEN
+                UPDATE daily_totals
+                SET amount = amount - COALESCE(OLD.amount, 0), n = n - 1
+                WHERE chat_id = OLD.chat_id AND tg_user_id = OLD.tg_user_id
+                  AND main_category = COALESCE(OLD.main_category, '')
+                  AND currency = COALESCE(OLD.currency, '')
+                  AND spent_date = OLD.spent_date
+                RETURNING n INTO left_n;
+
+                IF left_n IS NOT NULL AND left_n <= 0 THEN
+                    DELETE FROM daily_totals
+                    WHERE chat_id = OLD.chat_id AND tg_user_id = OLD.tg_user_id
+                      AND main_category = COALESCE(OLD.main_category, '')
+                      AND currency = COALESCE(OLD.currency, '')
+                      AND spent_date = OLD.spent_date;
+                END IF;
+            END IF;
+
+            IF TG_OP IN ('INSERT', 'UPDATE')
+               AND NEW.spent_date IS NOT NULL AND NEW.chat_id IS NOT NULL AND NEW.tg_user_id IS NOT NULL THEN
+                INSERT INTO daily_totals(chat_id, tg_user_id, main_category, currency, spent_date, amount, n)
+                VALUES (NEW.chat_id, NEW.tg_user_id, COALESCE(NEW.main_category, ''), COALESCE(NEW.currency, ''),
+                        NEW.spent_date, COALESCE(NEW.amount, 0), 1)
+                ON CONFLICT (chat_id, tg_user_id, main_category, currency, spent_date)
+                DO UPDATE SET amount = daily_totals.amount + EXCLUDED.amount, n = daily_totals.n + 1;
+            END IF;
+
+            RETURN NULL;
+        END;
+        $$;
+    """)
+
+    # запись в expenses блокируется до конца миграции: начальное заполнение и триггер согласованы
+    cur.execute("LOCK TABLE expenses IN SHARE ROW EXCLUSIVE MODE;")
+    cur.execute("DROP TRIGGER IF EXISTS expenses_daily_totals ON expenses;")
+    cur.execute("""
+        CREATE TRIGGER expenses_daily_totals
+        AFTER INSERT OR DELETE OR UPDATE OF chat_id, tg_user_id, amount, currency, main_category, spent_date
+        ON expenses
+        FOR EACH ROW EXECUTE FUNCTION expenses_daily_totals_trg();
+    """)
+
+    cur.execute("TRUNCATE daily_totals;")
+    cur.execute("""
+        INSERT INTO daily_totals(chat_id, tg_user_id, main_category, currency, spent_date, amount, n)
+        SELECT chat_id, tg_user_id, COALESCE(main_category, ''), COALESCE(currency, ''), spent_date,
+               COALESCE(SUM(amount), 0), COUNT(*)
+        FROM expenses
+        WHERE spent_date IS NOT NULL AND chat_id IS NOT NULL AND tg_user_id IS NOT NULL
+        GROUP BY 1, 2, 3, 4, 5;
+    """)
+
+
+def _migration_004_monthly_totals(cur):
+    """
+    monthly_totals — сумма расходов за календарный месяц по (chat, user, main, sub, currency).
+    Ведётся своим триггером на expenses, по тем же правилам, что daily_totals.
+    """
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS monthly_totals (
+            chat_id BIGINT NOT NULL,
+            tg_user_id BIGINT NOT NULL,
+            month DATE NOT NULL,
+            main_category TEXT NOT NULL,
+            sub_category TEXT NOT NULL,
+            currency TEXT NOT NULL,
+            amount NUMERIC NOT NULL DEFAULT 0,
+            n INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (chat_id, tg_user_id, month, main_category, sub_category, currency)
+        );
+    """)
+
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION expenses_monthly_totals_trg() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        DECLARE
+            left_n INTEGER;
+        BEGIN
+            IF TG_OP IN ('DELETE', 'UPDATE')
+               AND OLD.spent_date IS NOT NULL AND OLD.chat_id IS NOT NULL AND OLD.tg_user_id IS NOT NULL THEN
+                UPDATE monthly_totals
+                SET amount = amount - COALESCE(OLD.amount, 0), n = n - 1
+                WHERE chat_id = OLD.chat_id AND tg_user_id = OLD.tg_user_id
+                  AND month = date_trunc('month', OLD.spent_date)::date
+                  AND main_category = COALESCE(OLD.main_category, '')
+                  AND sub_category = COALESCE(OLD.sub_category, '')
+                  AND currency = COALESCE(OLD.currency, '')
+                RETURNING n INTO left_n;
+
+                IF left_n IS NOT NULL AND left_n <= 0 THEN
+                    DELETE FROM monthly_totals
+                    WHERE chat_id = OLD.chat_id AND tg_user_id = OLD.tg_user_id
+                      AND month = date_trunc('month', OLD.spent_date)::date
+                      AND main_category = COALESCE(OLD.main_category, '')
+                      AND sub_category = COALESCE(OLD.sub_category, '')
+                      AND currency = COALESCE(OLD.currency, '');
+                END IF;
+            END IF;
+
+            IF TG_OP IN ('INSERT', 'UPDATE')
+               AND NEW.spent_date IS NOT NULL AND NEW.chat_id IS NOT NULL AND NEW.tg_user_id IS NOT NULL THEN
+                INSERT INTO monthly_totals(chat_id, tg_user_id, month, main_category, sub_category, currency, amount, n)
+                VALUES (NEW.chat_id, NEW.tg_user_id, date_trunc('month', NEW.spent_date)::date,
+                        COALESCE(NEW.main_category, ''), COALESCE(NEW.sub_category, ''), COALESCE(NEW.currency, ''),
+                        COALESCE(NEW.amount, 0), 1)
+                ON CONFLICT (chat_id, tg_user_id, month, main_category, sub_category, currency)
+                DO UPDATE SET amount = monthly_totals.amount + EXCLUDED.amount, n = monthly_totals.n + 1;
+            END IF;
+
+            RETURN NULL;
+        END;
+        $$;
+    """)
+
+    cur.execute("LOCK TABLE expenses IN SHARE ROW EXCLUSIVE MODE;")
+    cur.execute("DROP TRIGGER IF EXISTS expenses_monthly_totals ON expenses;")
+    cur.execute("""
+        CREATE TRIGGER expenses_monthly_totals
+        AFTER INSERT OR DELETE OR UPDATE OF chat_id, tg_user_id, amount, currency, main_category, sub_category, spent_date
+        ON expenses
+        FOR EACH ROW EXECUTE FUNCTION expenses_monthly_totals_trg();
+    """)
+
+    cur.execute("TRUNCATE monthly_totals;")
+    cur.execute("""
+        INSERT INTO monthly_totals(chat_id, tg_user_id, month, main_category, sub_category, currency, amount, n)
+        SELECT chat_id, tg_user_id, date_trunc('month', spent_date)::date,
+               COALESCE(main_category, ''), COALESCE(sub_category, ''), COALESCE(currency, ''),
+               COALESCE(SUM(amount), 0), COUNT(*)
+        FROM expenses
+        WHERE spent_date IS NOT NULL AND chat_id IS NOT NULL AND tg_user_id IS NOT NULL
+        GROUP BY 1, 2, 3, 4, 5, 6;
+    """)
+
+
+def _migration_005_recent_expenses_index(cur):
+    # последние записи пользователя (delete last, /undo) и keyset-страницы истории:
+    # ORDER BY spent_at DESC, id DESC LIMIT n читается с начала индекса
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_expenses_chat_user_recent
+        ON expenses (chat_id, tg_user_id, spent_at DESC, id DESC)
+        INCLUDE (amount, currency, main_category, sub_category);
+    """)
+    # покрывается idx_expenses_chat_user_recent
+    cur.execute("DROP INDEX IF EXISTS idx_expenses_chat_user_time;")
+
+
+def _migration_006_record_expense_functions(cur):
+    """
+    Серверные функции записи расхода:
+    - budget_rollover: перенос остатка/перерасхода со вчера в daily_overrides на день (как ensure_daily_rollover_for_today)
+    - budget_status: лимиты и траты за день/месяц (для budget_info_from_status)
+    - record_expense: rollover + INSERT + status атомарно, одной строкой результата
+    """
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION budget_rollover(p_chat BIGINT, p_user BIGINT, p_main TEXT, p_cur TEXT, p_day DATE)
+        RETURNS TABLE(yesterday_limit NUMERIC, yesterday_spent NUMERIC, delta NUMERIC, today_limit NUMERIC, reason TEXT)
+        LANGUAGE plpgsql AS $$
+        #variable_conflict use_column
+        DECLARE
+            v_base NUMERIC;
+            v_y_limit NUMERIC;
+            v_y_spent NUMERIC;
+            v_delta NUMERIC;
+            v_today NUMERIC;
+            v_reason TEXT;
+        BEGIN
+            SELECT b.daily_limit INTO v_base
+            FROM budgets b
+            WHERE b.chat_id = p_chat AND b.tg_user_id = p_user AND b.main_category = p_main AND b.currency = p_cur;
+            IF v_base IS NULL THEN
+                RETURN;
+            END IF;
+
+            -- если уже есть override на день — ничего не делаем
+            IF EXISTS (
+                SELECT 1 FROM daily_overrides o
+                WHERE o.chat_id = p_chat AND o.tg_user_id = p_user AND o.main_category = p_main
+                  AND o.currency = p_cur AND o.day = p_day
+            ) THEN
+                RETURN;
+            END IF;
+
+            SELECT o.effective_limit INTO v_y_limit
+            FROM daily_overrides o
+            WHERE o.chat_id = p_chat AND o.tg_user_id = p_user AND o.main_category = p_main
+              AND o.currency = p_cur AND o.day = p_day - 1;
+            v_y_limit := COALESCE(v_y_limit, v_base);
+
+            SELECT COALESCE(SUM(t.amount), 0) INTO v_y_spent
+            FROM daily_totals t
+            WHERE t.chat_id = p_chat AND t.tg_user_id = p_user AND t.main_category = p_main
+              AND t.currency = p_cur AND t.spent_date = p_day - 1;
+
+            v_delta := v_y_limit - v_y_spent;  -- + остаток, - перерасход
+            v_today := GREATEST(v_base + v_delta, 0);
+
+            IF v_delta = 0 THEN
+                v_reason := 'Переноса нет: вчера потрачено ровно по дневному бюджету.';
+            ELSIF v_delta > 0 THEN
+                v_reason := format('Перенос остатка %s %s со вчера.', v_delta, p_cur);
+            ELSE
+                v_reason := format('Перенос перерасхода %s %s со вчера.', abs(v_delta), p_cur);
+            END IF;
 
-        # переносим старое category -> main_category
-        cur.execute("""
-            UPDATE expenses
-            SET main_category = COALESCE(main_category, category)
-            WHERE main_category IS NULL;
-        """)
+            INSERT INTO daily_overrides(chat_id, tg_user_id, main_category, currency, day, effective_limit, reason)
+            VALUES (p_chat, p_user, p_main, p_cur, p_day, v_today, v_reason)
+            ON CONFLICT (chat_id, tg_user_id, main_category, currency, day) DO NOTHING;
+            IF NOT FOUND THEN
+                -- параллельный запрос успел создать override раньше
+                RETURN;
+            END IF;
+
+            RETURN QUERY SELECT v_y_limit, v_y_spent, v_delta, v_today, v_reason;
+        END;
+        $$;
+    """)
+
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION budget_status(p_chat BIGINT, p_user BIGINT, p_main TEXT, p_cur TEXT, p_day DATE)
+        RETURNS TABLE(override_limit NUMERIC, override_reason TEXT, daily_limit NUMERIC, monthly_limit NUMERIC,
+                      day_spent NUMERIC, month_spent NUMERIC)
+        LANGUAGE sql STABLE AS $$
+            SELECT
+                o.effective_limit,
+                o.reason,
+                b.daily_limit,
+                b.monthly_limit,
+                (SELECT COALESCE(SUM(t.amount), 0)
+                 FROM daily_totals t
+                 WHERE t.chat_id = p_chat AND t.tg_user_id = p_user
+                   AND t.main_category = p_main AND t.currency = p_cur
+                   AND t.spent_date = p_day),
+                (SELECT COALESCE(SUM(t.amount), 0)
+                 FROM daily_totals t
+                 WHERE t.chat_id = p_chat AND t.tg_user_id = p_user
+                   AND t.main_category = p_main AND t.currency = p_cur
+                   AND t.spent_date BETWEEN date_trunc('month', p_day)::date AND p_day)
+            FROM (SELECT 1) AS one
+            LEFT JOIN budgets b
+              ON b.chat_id = p_chat AND b.tg_user_id = p_user
+             AND b.main_category = p_main AND b.currency = p_cur
+            LEFT JOIN daily_overrides o
+              ON o.chat_id = p_chat AND o.tg_user_id = p_user
+             AND o.main_category = p_main AND o.currency = p_cur AND o.day = p_day;
+        $$;
+    """)
+
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION record_expense(p_chat BIGINT, p_user BIGINT, p_amount NUMERIC, p_cur TEXT,
+                                                  p_main TEXT, p_sub TEXT, p_note TEXT,
+                                                  p_spent_at TIMESTAMP, p_spent_date DATE)
+        RETURNS TABLE(expense_id INTEGER,
+                      roll_yesterday_limit NUMERIC, roll_yesterday_spent NUMERIC, roll_delta NUMERIC,
+                      roll_today_limit NUMERIC, roll_reason TEXT,
+                      override_limit NUMERIC, override_reason TEXT, daily_limit NUMERIC, monthly_limit NUMERIC,
+                      day_spent NUMERIC, month_spent NUMERIC)
+        LANGUAGE plpgsql AS $$
+        #variable_conflict use_column
+        DECLARE
+            r RECORD;
+            s RECORD;
+            v_id INTEGER;
+        BEGIN
+            -- rollover ДО записи расхода (чтобы лимит дня был корректным)
+            SELECT * INTO r FROM budget_rollover(p_chat, p_user, p_main, p_cur, p_spent_date);
 
-        # подкатегорию по умолчанию: = main_category
-        cur.execute("""
-            UPDATE expenses
-            SET sub_category = COALESCE(sub_category, main_category)
-            WHERE sub_category IS NULL;
-        """)
+            INSERT INTO expenses(chat_id, tg_user_id, amount, currency, main_category, sub_category, note, spent_at, spent_date)
+            VALUES (p_chat, p_user, p_amount, p_cur, p_main, p_sub, p_note, p_spent_at, p_spent_date)
+            RETURNING expenses.id INTO v_id;
 
-        # если всё пусто — 'other'
-        cur.execute("""
-            UPDATE expenses
-            SET main_category = 'other'
-            WHERE main_category IS NULL OR TRIM(main_category) = '';
-        """)
-        cur.execute("""
-            UPDATE expenses
-            SET sub_category = 'other'
-            WHERE sub_category IS NULL OR TRIM(sub_category) = '';
-        """)
+            SELECT * INTO s FROM budget_status(p_chat, p_user, p_main, p_cur, p_spent_date);
 
-        # Приводим обязательность (с осторожностью): только если данные уже заполнены
-        # chat_id / tg_user_id / amount / currency / spent_at / spent_date обязательны для новой логики
-        # Если у вас ранее могли быть NULL — эти UPDATE выше уже закрывают часть.
-        cur.execute("ALTER TABLE expenses ALTER COLUMN currency SET DEFAULT 'UZS';")
-        cur.execute("ALTER TABLE expenses ALTER COLUMN spent_at SET DEFAULT NOW();")
-        cur.execute("ALTER TABLE expenses ALTER COLUMN spent_date SET DEFAULT CURRENT_DATE;")
+            RETURN QUERY SELECT v_id,
+                r.yesterday_limit, r.yesterday_spent, r.delta, r.today_limit, r.reason,
+                s.override_limit, s.override_reason, s.daily_limit, s.monthly_limit, s.day_spent, s.month_spent;
+        END;
+        $$;
+    """)
 
-        # Индексы
-        cur.execute("""
-            CREATE INDEX IF NOT EXISTS idx_expenses_chat_user_date
-            ON expenses (chat_id, tg_user_id, spent_date);
-        """)
-        cur.execute("""
-            CREATE INDEX IF NOT EXISTS idx_expenses_chat_user_time
-            ON expenses (chat_id, tg_user_id, spent_at);
-        """)
 
-        # --- budgets ---
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS budgets (
-                id SERIAL PRIMARY KEY,
-                chat_id BIGINT NOT NULL,
-                tg_user_id BIGINT NOT NULL,
-                category TEXT,
-                main_category TEXT,
-                currency TEXT NOT NULL DEFAULT 'UZS',
-                daily_limit NUMERIC,
-                monthly_limit NUMERIC,
-                created_at TIMESTAMP NOT NULL DEFAULT NOW(),
-                updated_at TIMESTAMP NOT NULL DEFAULT NOW()
-            );
-        """)
+def _migration_007_rollover_chain(cur):
+    """
+    Перенос через несколько пропущенных дней одним запросом.
+    rollover_chain считает цепочку лимитов на [p_from, p_to] от override дня p_from-1
+    (если его нет — от базового лимита): L(d) = max(0, base + L(d-1) - spent(d-1)).
+    Рекурсия с нулевым полом раскрывается оконными функциями: при P(d) = Σ(base - spent(k-1)), k ≤ d,
+    L(d) = P(d) + max(L(p_from-1), -min P(k≤d)).
+    budget_rollover теперь дописывает все недостающие дни с последнего override (не старше года) пачкой.
+    """
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION rollover_chain(p_chat BIGINT, p_user BIGINT, p_main TEXT, p_cur TEXT,
+                                                  p_from DATE, p_to DATE)
+        RETURNS TABLE(day DATE, yesterday_limit NUMERIC, yesterday_spent NUMERIC, delta NUMERIC,
+                      today_limit NUMERIC, reason TEXT)
+        LANGUAGE sql STABLE AS $$
+            WITH params AS (
+                SELECT b.daily_limit AS base,
+                       COALESCE(
+                           (SELECT o.effective_limit
+                            FROM daily_overrides o
+                            WHERE o.chat_id = p_chat AND o.tg_user_id = p_user AND o.main_category = p_main
+                              AND o.currency = p_cur AND o.day = p_from - 1),
+                           b.daily_limit
+                       ) AS anchor_limit
+                FROM budgets b
+                WHERE b.chat_id = p_chat AND b.tg_user_id = p_user AND b.main_category = p_main
+                  AND b.currency = p_cur AND b.daily_limit IS NOT NULL
+            ),
+            steps AS (
+                -- на каждый день цепочки: сколько потрачено накануне
+                SELECT g.d::date AS d, COALESCE(t.amount, 0) AS prev_spent
+                FROM generate_series(p_from, p_to, INTERVAL '1 day') AS g(d)
+                LEFT JOIN daily_totals t
+                  ON t.chat_id = p_chat AND t.tg_user_id = p_user AND t.main_category = p_main
+                 AND t.currency = p_cur AND t.spent_date = g.d::date - 1
+            ),
+            walk AS (
+                SELECT s.d, s.prev_spent, p.anchor_limit,
+                       SUM(p.base - s.prev_spent) OVER (ORDER BY s.d ROWS UNBOUNDED PRECEDING) AS p_sum
+                FROM steps s
+                CROSS JOIN params p
+            ),
+            chain AS (
+                SELECT d, prev_spent, anchor_limit,
+                       p_sum + GREATEST(anchor_limit, -MIN(p_sum) OVER (ORDER BY d ROWS UNBOUNDED PRECEDING)) AS lim
+                FROM walk
+            ),
+            links AS (
+                SELECT d, prev_spent, lim,
+                       COALESCE(LAG(lim) OVER (ORDER BY d), anchor_limit) AS prev_lim
+                FROM chain
+            )
+            SELECT d,
+                   prev_lim,
+                   prev_spent,
+                   prev_lim - prev_spent,
+                   lim,
+                   CASE
+                       WHEN prev_lim - prev_spent = 0 THEN 'Переноса нет: вчера потрачено ровно по дневному бюджету.'
+                       WHEN prev_lim - prev_spent > 0 THEN format('Перенос остатка %s %s со вчера.', prev_lim - prev_spent, p_cur)
+                       ELSE format('Перенос перерасхода %s %s со вчера.', abs(prev_lim - prev_spent), p_cur)
+                   END
+            FROM links
+            ORDER BY d;
+        $$;
+    """)
+
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION budget_rollover(p_chat BIGINT, p_user BIGINT, p_main TEXT, p_cur TEXT, p_day DATE)
+        RETURNS TABLE(yesterday_limit NUMERIC, yesterday_spent NUMERIC, delta NUMERIC, today_limit NUMERIC, reason TEXT)
+        LANGUAGE plpgsql AS $$
+        #variable_conflict use_column
+        DECLARE
+            v_anchor DATE;
+        BEGIN
+            IF NOT EXISTS (
+                SELECT 1 FROM budgets b
+                WHERE b.chat_id = p_chat AND b.tg_user_id = p_user AND b.main_category = p_main
+                  AND b.currency = p_cur AND b.daily_limit IS NOT NULL
+            ) THEN
+                RETURN;
+            END IF;
+
+            -- если уже есть override на день — ничего не делаем
+            IF EXISTS (
+                SELECT 1 FROM daily_overrides o
+                WHERE o.chat_id = p_chat AND o.tg_user_id = p_user AND o.main_category = p_main
+                  AND o.currency = p_cur AND o.day = p_day
+            ) THEN
+                RETURN;
+            END IF;
+
+            -- последний посчитанный день; цепочку продолжаем с него (разрыв не больше года)
+            SELECT MAX(o.day) INTO v_anchor
+            FROM daily_overrides o
+            WHERE o.chat_id = p_chat AND o.tg_user_id = p_user AND o.main_category = p_main
+              AND o.currency = p_cur AND o.day < p_day AND o.day >= p_day - 366;
+
+            RETURN QUERY
+            WITH c AS (
+                SELECT * FROM rollover_chain(p_chat, p_user, p_main, p_cur, COALESCE(v_anchor + 1, p_day), p_day)
+            ), ins AS (
+                INSERT INTO daily_overrides(chat_id, tg_user_id, main_category, currency, day, effective_limit, reason)
+                SELECT p_chat, p_user, p_main, p_cur, c.day, c.today_limit, c.reason
+                FROM c
+                ON CONFLICT (chat_id, tg_user_id, main_category, currency, day) DO NOTHING
+                RETURNING daily_overrides.day AS d
+            )
+            SELECT c.yesterday_limit, c.yesterday_spent, c.delta, c.today_limit, c.reason
+            FROM c
+            JOIN ins ON ins.d = c.day
+            WHERE c.day = p_day;
+        END;
+        $$;
+    """)
+
+
+def _migration_008_rollover_dirty(cur):
+    """
+    rollover_dirty — с какого дня устарели overrides по (chat, user, main_category, currency).
+    Изменение daily_totals за прошедший день (расход задним числом, удаление, правка) сдвигает from_day
+    на следующий день (LEAST с уже записанным). Фоновая задача пересчитывает цепочку rollover_recompute
+    и удаляет обработанные ключи.
+    """
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS rollover_dirty (
+            chat_id BIGINT NOT NULL,
+            tg_user_id BIGINT NOT NULL,
+            main_category TEXT NOT NULL,
+            currency TEXT NOT NULL,
+            from_day DATE NOT NULL,
+            updated_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (chat_id, tg_user_id, main_category, currency)
+        );
+    """)
+
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION daily_totals_rollover_dirty_trg() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        DECLARE
+            r daily_totals%ROWTYPE;
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                r := OLD;
+            ELSE
+                r := NEW;
+            END IF;
+
+            -- сегодняшние траты влияют только на завтрашний override, его ещё нет
+            IF r.spent_date < CURRENT_DATE AND r.main_category <> '' THEN
+                INSERT INTO rollover_dirty(chat_id, tg_user_id, main_category, currency, from_day)
+                VALUES (r.chat_id, r.tg_user_id, r.main_category, r.currency, r.spent_date + 1)
+                ON CONFLICT (chat_id, tg_user_id, main_category, currency)
+                DO UPDATE SET from_day = LEAST(rollover_dirty.from_day, EXCLUDED.from_day), updated_at = NOW();
+            END IF;
+
+            RETURN NULL;
+        END;
+        $$;
+    """)
+    cur.execute("DROP TRIGGER IF EXISTS daily_totals_rollover_dirty ON daily_totals;")
+    cur.execute("""
+        CREATE TRIGGER daily_totals_rollover_dirty
+        AFTER INSERT OR DELETE OR UPDATE OF amount ON daily_totals
+        FOR EACH ROW EXECUTE FUNCTION daily_totals_rollover_dirty_trg();
+    """)
+
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION rollover_recompute(p_chat BIGINT, p_user BIGINT, p_main TEXT, p_cur TEXT, p_from DATE)
+        RETURNS INTEGER
+        LANGUAGE plpgsql AS $$
+        DECLARE
+            v_to DATE;
+            v_n INTEGER;
+        BEGIN
+            -- пересчитываем только уже посчитанные дни: дальше цепочку продолжит budget_rollover
+            SELECT MAX(o.day) INTO v_to
+            FROM daily_overrides o
+            WHERE o.chat_id = p_chat AND o.tg_user_id = p_user AND o.main_category = p_main
+              AND o.currency = p_cur AND o.day >= p_from;
+
+            IF v_to IS NULL OR NOT EXISTS (
+                SELECT 1 FROM budgets b
+                WHERE b.chat_id = p_chat AND b.tg_user_id = p_user AND b.main_category = p_main
+                  AND b.currency = p_cur AND b.daily_limit IS NOT NULL
+            ) THEN
+                RETURN 0;
+            END IF;
+
+            WITH c AS (
+                SELECT * FROM rollover_chain(p_chat, p_user, p_main, p_cur, GREATEST(p_from, v_to - 366), v_to)
+            ), up AS (
+                INSERT INTO daily_overrides(chat_id, tg_user_id, main_category, currency, day, effective_limit, reason)
+                SELECT p_chat, p_user, p_main, p_cur, c.day, c.today_limit, c.reason
+                FROM c
+                ON CONFLICT (chat_id, tg_user_id, main_category, currency, day)
+                DO UPDATE SET effective_limit = EXCLUDED.effective_limit, reason = EXCLUDED.reason, created_at = NOW()
+                WHERE (daily_overrides.effective_limit, daily_overrides.reason)
+                      IS DISTINCT FROM (EXCLUDED.effective_limit, EXCLUDED.reason)
+                RETURNING 1
+            )
+            SELECT COUNT(*) INTO v_n FROM up;
+
+            RETURN v_n;
+        END;
+        $$;
+    """)
+
+
+def _migration_009_rollover_dirty_no_clock(cur):
+    """
+    Пометка rollover_dirty без CURRENT_DATE: часовой пояс БД может не совпадать с приложением.
+    Изменение дня D устарело, если за ключом уже посчитан override на день позже D.
+    attempts/last_error — неудачные пересчёты ключа; новое изменение даёт ключу новые попытки.
+    """
+    cur.execute("ALTER TABLE rollover_dirty ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0;")
+    cur.execute("ALTER TABLE rollover_dirty ADD COLUMN IF NOT EXISTS last_error TEXT;")
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION daily_totals_rollover_dirty_trg() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        DECLARE
+            r daily_totals%ROWTYPE;
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                r := OLD;
+            ELSE
+                r := NEW;
+            END IF;
+
+            IF r.main_category <> '' AND EXISTS (
+                SELECT 1 FROM daily_overrides o
+                WHERE o.chat_id = r.chat_id AND o.tg_user_id = r.tg_user_id AND o.main_category = r.main_category
+                  AND o.currency = r.currency AND o.day > r.spent_date
+            ) THEN
+                INSERT INTO rollover_dirty(chat_id, tg_user_id, main_category, currency, from_day)
+                VALUES (r.chat_id, r.tg_user_id, r.main_category, r.currency, r.spent_date + 1)
+                ON CONFLICT (chat_id, tg_user_id, main_category, currency)
+                DO UPDATE SET from_day = LEAST(rollover_dirty.from_day, EXCLUDED.from_day),
+                              attempts = 0, updated_at = NOW();
+            END IF;
+
+            RETURN NULL;
+        END;
+        $$;
+    """)
+
+
+MIGRATIONS: List[Tuple[int, str, Any]] = [
+    (1, "baseline schema", _migration_001_baseline),
+    (2, "no-op (expenses indexes are built by build_expense_indexes)", _migration_002_noop),
+    (3, "daily_totals maintained by trigger", _migration_003_daily_totals),
+    (4, "monthly_totals rollup maintained by trigger", _migration_004_monthly_totals),
+    (5, "index for last-N expenses lookup", _migration_005_recent_expenses_index),
+    (6, "server-side rollover / budget status / record_expense", _migration_006_record_expense_functions),
+    (7, "set-based multi-day rollover catch-up", _migration_007_rollover_chain),
+    (8, "dirty-range tracker for rollover recompute", _migration_008_rollover_dirty),
+    (9, "rollover dirty marking without CURRENT_DATE, per-key failures", _migration_009_rollover_dirty_no_clock),
+]
+
+
+def get_schema_version() -> int:
+    try:
+        with db() as conn, conn.cursor() as cur:
+            cur.execute("SELECT v FROM bot_meta WHERE k=%s;", (SCHEMA_VERSION_KEY,))
+            row = cur.fetchone()
+    except psycopg2.errors.UndefinedTable:
+        return 0
+    return int(row["v"]) if row else 0
 
-        cur.execute("ALTER TABLE budgets ADD COLUMN IF NOT EXISTS chat_id BIGINT;")
-        cur.execute("ALTER TABLE budgets ADD COLUMN IF NOT EXISTS tg_user_id BIGINT;")
-        cur.execute("ALTER TABLE budgets ADD COLUMN IF NOT EXISTS category TEXT;")
-        cur.execute("ALTER TABLE budgets ADD COLUMN IF NOT EXISTS main_category TEXT;")
-        cur.execute("ALTER TABLE budgets ADD COLUMN IF NOT EXISTS currency TEXT;")
-        cur.execute("ALTER TABLE budgets ADD COLUMN IF NOT EXISTS daily_limit NUMERIC;")
-        cur.execute("ALTER TABLE budgets ADD COLUMN IF NOT EXISTS monthly_limit NUMERIC;")
-        cur.execute("ALTER TABLE budgets ADD COLUMN IF NOT EXISTS created_at TIMESTAMP;")
-        cur.execute("ALTER TABLE budgets ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP;")
 
-        cur.execute("""
-            UPDATE budgets
-            SET main_category = COALESCE(main_category, category)
-            WHERE main_category IS NULL;
-        """)
-        cur.execute("""
-            UPDATE budgets
-            SET main_category = 'other'
-            WHERE main_category IS NULL OR TRIM(main_category) = '';
-        """)
-        cur.execute("""
-            UPDATE budgets
-            SET currency = COALESCE(currency, 'UZS')
-            WHERE currency IS NULL OR TRIM(currency) = '';
-        """)
+def _read_schema_version_locked(cur) -> int:
+    cur.execute("SELECT to_regclass('bot_meta') IS NOT NULL AS ok;")
+    if not cur.fetchone()["ok"]:
+        return 0
+    cur.execute("SELECT v FROM bot_meta WHERE k=%s;", (SCHEMA_VERSION_KEY,))
+    row = cur.fetchone()
+    return int(row["v"]) if row else 0
 
-        # уникальность бюджета на (chat,user,main_category,currency)
-        cur.execute("""
-            CREATE UNIQUE INDEX IF NOT EXISTS budgets_unique
-            ON budgets (chat_id, tg_user_id, main_category, currency);
-        """)
 
-        # --- daily_overrides (для переносов) ---
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS daily_overrides (
-                id SERIAL PRIMARY KEY,
-                chat_id BIGINT NOT NULL,
-                tg_user_id BIGINT NOT NULL,
-                main_category TEXT NOT NULL,
-                currency TEXT NOT NULL,
-                day DATE NOT NULL,
-                effective_limit NUMERIC NOT NULL,
-                reason TEXT NOT NULL,
-                created_at TIMESTAMP NOT NULL DEFAULT NOW()
-            );
-        """)
-        cur.execute("""
-            CREATE UNIQUE INDEX IF NOT EXISTS daily_overrides_unique
-            ON daily_overrides (chat_id, tg_user_id, main_category, currency, day);
-        """)
+def init_db():
+    """
+    Применяет недостающие миграции схемы.
+    При старте — один SELECT версии; DDL выполняются только для новых шагов,
+    каждый шаг в своей транзакции вместе с записью новой версии.
+    """
+    current = get_schema_version()
+    pending = [m for m in MIGRATIONS if m[0] > current]
+    if not pending:
+        logger.info("DB schema is up to date (version %s)", current)
+
+    for version, name, migrate in pending:
+        with db() as conn, conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_xact_lock(%s);", (MIGRATION_LOCK_ID,))
+            # другой инстанс мог успеть применить шаг, пока мы ждали блокировку
+            if version <= _read_schema_version_locked(cur):
+                continue
+            logger.info("Applying DB migration %s: %s", version, name)
+            migrate(cur)
+            cur.execute("""
+                INSERT INTO bot_meta(k, v, updated_at)
+                VALUES (%s, %s, NOW())
+                ON CONFLICT(k) DO UPDATE SET v=EXCLUDED.v, updated_at=NOW();
+            """, (SCHEMA_VERSION_KEY, str(version)))
+
+    if EXPENSES_PARTITIONED:
+        partition_expenses_table()
+        ensure_expense_partitions()
+
+
+def build_expense_indexes():
+    """
+    Строит EXPENSES_COVERING_INDEXES через CREATE INDEX CONCURRENTLY (autocommit, без блокировки записи),
+    затем удаляет устаревшие индексы. Недостроенный (invalid) индекс после сбоя пересоздаётся.
+    На секционированной expenses CONCURRENTLY не поддерживается — там обычный CREATE INDEX.
+    """
+    conn = DB_POOL.acquire()
+    try:
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute("SELECT relkind FROM pg_class WHERE oid = 'expenses'::regclass;")
+            partitioned = cur.fetchone()["relkind"] == "p"
+            for name, ddl in EXPENSES_COVERING_INDEXES:
+                cur.execute("""
+                    SELECT i.indisvalid
+                    FROM pg_index i
+                    JOIN pg_class c ON c.oid = i.indexrelid
+                    WHERE c.relname = %s;
+                """, (name,))
+                row = cur.fetchone()
+                if row and row["indisvalid"]:
+                    continue
+                if row:
+                    cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name};")
+                logger.info("building index %s", name)
+                cur.execute(ddl.replace(" CONCURRENTLY", "") if partitioned else ddl)
+
+            for name in EXPENSES_OBSOLETE_INDEXES:
+                cur.execute(f"DROP INDEX {'' if partitioned else 'CONCURRENTLY '}IF EXISTS {name};")
+    finally:
+        conn.autocommit = False
+        DB_POOL.release(conn)
+
+
+# =========================
+# Partitioning (expenses по месяцам spent_date)
+# =========================
+# Включается EXPENSES_PARTITIONED=1. Существующая таблица один раз переносится в
+# секционированную (PARTITION BY RANGE (spent_date), секция на месяц + DEFAULT),
+# индексы и триггеры переносятся как есть. Все запросы по периоду фильтруют spent_date,
+# поэтому Postgres отсекает лишние секции сам.
+
+
+def _partition_name(month: date) -> str:
+    return f"expenses_y{month.year:04d}m{month.month:02d}"
+
+
+def _next_month(month: date) -> date:
+    return month_start(month + timedelta(days=32))
+
+
+def _create_month_partition(cur, month: date):
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {_partition_name(month)}
+        PARTITION OF expenses
+        FOR VALUES FROM (%s) TO (%s);
+    """, (month, _next_month(month)))
+
+
+def partition_expenses_table():
+    """
+    Одноразовое преобразование expenses в секционированную таблицу.
+    Требует заполненного spent_date (см. run_backfills): пока backfill не закончен — пропускаем,
+    попробуем при следующем старте. Таблица блокируется на время копирования.
+    """
+    with db() as conn, conn.cursor() as cur:
+        cur.execute("SELECT pg_advisory_xact_lock(%s);", (MIGRATION_LOCK_ID,))
+        cur.execute("SELECT relkind FROM pg_class WHERE oid = 'expenses'::regclass;")
+        if cur.fetchone()["relkind"] == "p":
+            return
 
-        # --- память диалога (контекст) ---
+        cur.execute("SELECT EXISTS (SELECT 1 FROM expenses WHERE spent_date IS NULL) AS has_null;")
+        if cur.fetchone()["has_null"]:
+            logger.warning("expenses partitioning postponed: spent_date backfill is not finished")
+            return
+
+        logger.info("Converting expenses to a partitioned table")
+        cur.execute("LOCK TABLE expenses IN ACCESS EXCLUSIVE MODE;")
+
+        # индексы и триггеры старой таблицы — чтобы воспроизвести их на новой
         cur.execute("""
-            CREATE TABLE IF NOT EXISTS convo_memory (
-                chat_id BIGINT NOT NULL,
-                tg_user_id BIGINT NOT NULL,
-                summary TEXT NOT NULL DEFAULT '',
-                updated_at TIMESTAMP NOT NULL DEFAULT NOW(),
-                PRIMARY KEY(chat_id, tg_user_id)
-            );
+            SELECT pg_get_indexdef(i.indexrelid) AS ddl
+            FROM pg_index i
+            WHERE i.indrelid = 'expenses'::regclass AND NOT i.indisprimary;
         """)
+        index_ddl = [r["ddl"] for r in cur.fetchall()]
         cur.execute("""
-            CREATE TABLE IF NOT EXISTS convo_messages (
-                id SERIAL PRIMARY KEY,
-                chat_id BIGINT NOT NULL,
-                tg_user_id BIGINT NOT NULL,
-                role TEXT NOT NULL,
-                content TEXT NOT NULL,
-                created_at TIMESTAMP NOT NULL DEFAULT NOW()
-            );
+            SELECT pg_get_triggerdef(t.oid) AS ddl
+            FROM pg_trigger t
+            WHERE t.tgrelid = 'expenses'::regclass AND NOT t.tgisinternal;
         """)
+        trigger_ddl = [r["ddl"] for r in cur.fetchall()]
+        cur.execute("SELECT pg_get_serial_sequence('expenses', 'id') AS seq;")
+        seq = cur.fetchone()["seq"]
+        cur.execute("SELECT MIN(spent_date) AS lo FROM expenses;")
+        lo = cur.fetchone()["lo"] or today()
+
+        cur.execute("ALTER TABLE expenses RENAME TO expenses_unpartitioned;")
         cur.execute("""
-            CREATE INDEX IF NOT EXISTS convo_messages_idx
-            ON convo_messages (chat_id, tg_user_id, created_at DESC);
+            CREATE TABLE expenses (LIKE expenses_unpartitioned INCLUDING DEFAULTS)
+            PARTITION BY RANGE (spent_date);
         """)
+        cur.execute("ALTER TABLE expenses ALTER COLUMN spent_date SET NOT NULL;")
+        cur.execute("ALTER TABLE expenses ADD PRIMARY KEY (id, spent_date);")
+
+        month = month_start(lo)
+        horizon = month_start(today())
+        for _ in range(PARTITION_MONTHS_AHEAD):
+            horizon = _next_month(horizon)
+        while month <= horizon:
+            _create_month_partition(cur, month)
+            month = _next_month(month)
+        cur.execute("CREATE TABLE IF NOT EXISTS expenses_default PARTITION OF expenses DEFAULT;")
+
+        # триггеров на новой таблице ещё нет: daily/monthly_totals уже учитывают эти строки
+        cur.execute("INSERT INTO expenses SELECT * FROM expenses_unpartitioned;")
+        if seq:
+            cur.execute(f"ALTER SEQUENCE {seq} OWNED BY expenses.id;")
+        cur.execute("DROP TABLE expenses_unpartitioned;")
+
+        # определения сняты до переименования и ссылаются на expenses, имена индексов уже свободны
+        for ddl in index_ddl + trigger_ddl:
+            cur.execute(ddl)
+        logger.info("expenses partitioned: %s indexes, %s triggers recreated", len(index_ddl), len(trigger_ddl))
+
+
+def ensure_expense_partitions(months_ahead: int = PARTITION_MONTHS_AHEAD):
+    """Создаёт секции на текущий и следующие months_ahead месяцев (если таблица секционирована)."""
+    with db() as conn, conn.cursor() as cur:
+        cur.execute("SELECT relkind FROM pg_class WHERE oid = 'expenses'::regclass;")
+        if cur.fetchone()["relkind"] != "p":
+            return
+        month = month_start(today())
+        for _ in range(months_ahead + 1):
+            cur.execute("SAVEPOINT part;")
+            try:
+                _create_month_partition(cur, month)
+                cur.execute("RELEASE SAVEPOINT part;")
+            except psycopg2.Error as e:
+                # например, в DEFAULT уже лежат строки этого месяца
+                cur.execute("ROLLBACK TO SAVEPOINT part;")
+                logger.error("partition %s not created: %s", _partition_name(month), e)
+            month = _next_month(month)
+
 
-        # --- состояния (например подтверждение удаления) ---
+async def partition_job(context: ContextTypes.DEFAULT_TYPE):
+    await run_db(ensure_expense_partitions)
+
+
+# =========================
+# Backfill (фоновое заполнение старых строк)
+# =========================
+# Каждый шаг идёт по expenses пачками по id (keyset), каждая пачка — своя транзакция.
+# Прогресс (последний обработанный id или 'done') хранится в bot_meta под 'backfill:<name>',
+# после рестарта шаг продолжается с места остановки. Шаги выполняются по порядку.
+
+# (name, table, SET, условие строки)
+BACKFILLS: List[Tuple[str, str, str, str]] = [
+    # заполняем spent_at если NULL
+    ("expenses_spent_at", "expenses",
+     "spent_at = NOW()",
+     "spent_at IS NULL"),
+    # заполняем spent_date если NULL (из spent_at или today)
+    ("expenses_spent_date", "expenses",
+     "spent_date = COALESCE(spent_date, (spent_at::date), CURRENT_DATE)",
+     "spent_date IS NULL"),
+    # переносим старое category -> main_category
+    ("expenses_main_category", "expenses",
+     "main_category = COALESCE(main_category, category)",
+     "main_category IS NULL"),
+    # подкатегорию по умолчанию: = main_category
+    ("expenses_sub_category", "expenses",
+     "sub_category = COALESCE(sub_category, main_category)",
+     "sub_category IS NULL"),
+    # если всё пусто — 'other'
+    ("expenses_main_other", "expenses",
+     "main_category = 'other'",
+     "main_category IS NULL OR TRIM(main_category) = ''"),
+    ("expenses_sub_other", "expenses",
+     "sub_category = 'other'",
+     "sub_category IS NULL OR TRIM(sub_category) = ''"),
+]
+
+
+def backfill_batch(name: str, table: str, set_sql: str, where_sql: str, after_id: int, batch_size: int) -> Tuple[Optional[int], int]:
+    """
+    Одна пачка: следующие batch_size id после after_id, обновляются только подходящие строки.
+    Возвращает (последний id пачки или None если строк больше нет, сколько обновлено).
+    Чекпоинт пишется в той же транзакции.
+    """
+    with db() as conn, conn.cursor() as cur:
+        cur.execute(f"""
+            WITH batch AS (
+                SELECT id FROM {table}
+                WHERE id > %s
+                ORDER BY id
+                LIMIT %s
+            ), upd AS (
+                UPDATE {table}
+                SET {set_sql}
+                WHERE id IN (SELECT id FROM batch) AND ({where_sql})
+                RETURNING 1
+            )
+            SELECT (SELECT MAX(id) FROM batch) AS last_id, (SELECT COUNT(*) FROM upd) AS updated;
+        """, (after_id, batch_size))
+        row = cur.fetchone()
+        last_id = int(row["last_id"]) if row["last_id"] is not None else None
         cur.execute("""
-            CREATE TABLE IF NOT EXISTS user_states (
-                chat_id BIGINT NOT NULL,
-                tg_user_id BIGINT NOT NULL,
-                state_json TEXT NOT NULL,
-                updated_at TIMESTAMP NOT NULL DEFAULT NOW(),
-                PRIMARY KEY(chat_id, tg_user_id)
-            );
-        """)
+            INSERT INTO bot_meta(k, v, updated_at)
+            VALUES (%s, %s, NOW())
+            ON CONFLICT(k) DO UPDATE SET v=EXCLUDED.v, updated_at=NOW();
+        """, (f"backfill:{name}", str(last_id) if last_id is not None else "done"))
+        return last_id, int(row["updated"])
 
-        conn.commit()
+
+def run_backfills(batch_size: int = BACKFILL_BATCH_SIZE, pause_s: float = BACKFILL_PAUSE_S):
+    with db() as conn, conn.cursor() as cur:
+        cur.execute("SELECT k, v FROM bot_meta WHERE k LIKE 'backfill:%';")
+        progress = {r["k"][len("backfill:"):]: r["v"] for r in cur.fetchall()}
+
+    for name, table, set_sql, where_sql in BACKFILLS:
+        state = progress.get(name, "0")
+        if state == "done":
+            continue
+        after_id = int(state)
+        total = 0
+        logger.info("backfill %s: start after id=%s", name, after_id)
+        while True:
+            last_id, updated = backfill_batch(name, table, set_sql, where_sql, after_id, batch_size)
+            if last_id is None:
+                break
+            after_id = last_id
+            total += updated
+            if pause_s:
+                time.sleep(pause_s)
+        logger.info("backfill %s: done, updated %s rows", name, total)
+
+
+def start_backfills():
+    """Запускает build_expense_indexes и run_backfills в фоновом потоке: бот обслуживает апдейты параллельно."""
+    def _run():
+        try:
+            build_expense_indexes()
+        except Exception:
+            logger.exception("index build failed; will retry on next start")
+        try:
+            run_backfills()
+        except Exception:
+            logger.exception("backfill failed; will resume from checkpoint on next start")
+
+    threading.Thread(target=_run, name="backfill", daemon=True).start()
 
 
 # =========================
 # DB helpers
 # =========================
 
+_TOUCHED_CHATS: Dict[int, float] = {}
+_TOUCHED_LOCK = threading.Lock()
+
+
 def touch_chat(chat_id: int):
-    with db() as conn, conn.cursor() as cur:
-        cur.execute("""
-            INSERT INTO known_chats(chat_id, first_seen, last_seen)
-            VALUES (%s, NOW(), NOW())
-            ON CONFLICT(chat_id) DO UPDATE SET last_seen = NOW();
-        """, (chat_id,))
-        conn.commit()
+    """Отметить активность чата. Без запроса к БД: повторы схлопываются до flush_touched_chats."""
+    with _TOUCHED_LOCK:
+        _TOUCHED_CHATS[chat_id] = time.time()
+
+
+def flush_touched_chats() -> int:
+    """Записать накопленные last_seen в known_chats одним upsert. Возвращает число чатов."""
+    with _TOUCHED_LOCK:
+        if not _TOUCHED_CHATS:
+            return 0
+        batch = dict(_TOUCHED_CHATS)
+        _TOUCHED_CHATS.clear()
+
+    try:
+        with db() as conn, conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO known_chats(chat_id, first_seen, last_seen)
+                SELECT t.chat_id, to_timestamp(t.ts)::timestamp, to_timestamp(t.ts)::timestamp
+                FROM unnest(%s::bigint[], %s::float8[]) AS t(chat_id, ts)
+                ON CONFLICT(chat_id) DO UPDATE SET last_seen = GREATEST(known_chats.last_seen, EXCLUDED.last_seen);
+            """, (list(batch.keys()), list(batch.values())))
+            conn.commit()
+    except Exception:
+        # вернуть в буфер, запишем в следующий раз
+        with _TOUCHED_LOCK:
+            for chat_id, ts in batch.items():
+                _TOUCHED_CHATS[chat_id] = max(ts, _TOUCHED_CHATS.get(chat_id, 0.0))
+        raise
+    return len(batch)
+
+
+async def touch_flush_job(context: ContextTypes.DEFAULT_TYPE):
+    await run_db(flush_touched_chats)
 
 
 def get_meta(k: str) -> Optional[str]:
@@ -373,6 +1673,42 @@ def get_state(chat_id: int, user_id: int) -> Optional[Dict[str, Any]]:
             return None
 
 
+# (chat, user) с ожидающим ответа состоянием (pending) — копия user_states в памяти,
+# чтобы сообщения без упоминания бота не ходили в БД
+PENDING_STATES: set = set()
+_PENDING_LOCK = threading.Lock()
+
+
+def load_pending_states() -> int:
+    with db() as conn, conn.cursor() as cur:
+        cur.execute("""SELECT chat_id, tg_user_id, state_json FROM user_states WHERE state_json LIKE '%"pending"%';""")
+        rows = cur.fetchall()
+    keys = set()
+    for r in rows:
+        try:
+            if json.loads(r["state_json"]).get("pending"):
+                keys.add((int(r["chat_id"]), int(r["tg_user_id"])))
+        except Exception:
+            continue
+    with _PENDING_LOCK:
+        PENDING_STATES.clear()
+        PENDING_STATES.update(keys)
+    return len(keys)
+
+
+def _sync_pending_state(chat_id: int, user_id: int, pending: bool):
+    # меняем копию только после commit: при откате user_states и PENDING_STATES не расходятся
+    with _PENDING_LOCK:
+        if pending:
+            PENDING_STATES.add((chat_id, user_id))
+        else:
+            PENDING_STATES.discard((chat_id, user_id))
+
+
+def has_pending_state(chat_id: int, user_id: int) -> bool:
+    return (chat_id, user_id) in PENDING_STATES
+
+
 def set_state(chat_id: int, user_id: int, state: Dict[str, Any]):
     with db() as conn, conn.cursor() as cur:
         cur.execute("""
@@ -381,12 +1717,14 @@ def set_state(chat_id: int, user_id: int, state: Dict[str, Any]):
             ON CONFLICT(chat_id, tg_user_id) DO UPDATE SET state_json=EXCLUDED.state_json, updated_at=NOW();
         """, (chat_id, user_id, json.dumps(state, ensure_ascii=False)))
         conn.commit()
+    after_commit(functools.partial(_sync_pending_state, chat_id, user_id, bool(state.get("pending"))))
 
 
 def clear_state(chat_id: int, user_id: int):
     with db() as conn, conn.cursor() as cur:
         cur.execute("DELETE FROM user_states WHERE chat_id=%s AND tg_user_id=%s;", (chat_id, user_id))
         conn.commit()
+    after_commit(functools.partial(_sync_pending_state, chat_id, user_id, False))
 
 
 def set_budget_base(chat_id: int, user_id: int, main_category: str, currency: str,
@@ -401,79 +1739,137 @@ def set_budget_base(chat_id: int, user_id: int, main_category: str, currency: st
         conn.commit()
 
 
-def get_budget_base(chat_id: int, user_id: int, main_category: str, currency: str) -> Optional[Dict[str, Any]]:
+def find_expenses_page(chat_id: int, user_id: int, start: date, end: date,
+                       after: Optional[Tuple[datetime, int]] = None,
+                       limit: int = HISTORY_PAGE_SIZE) -> List[Dict[str, Any]]:
+    """
+    Одна страница истории, новые сверху (spent_at DESC, id DESC).
+    after — (spent_at, id) последней записи предыдущей страницы (keyset, без OFFSET).
+    """
     with db() as conn, conn.cursor() as cur:
-        cur.execute("""
-            SELECT daily_limit, monthly_limit
-            FROM budgets
-            WHERE chat_id=%s AND tg_user_id=%s AND main_category=%s AND currency=%s;
-        """, (chat_id, user_id, main_category, currency))
-        row = cur.fetchone()
-        return row if row else None
+        if after:
+            cur.execute("""
+                SELECT id, amount, currency, main_category, sub_category, note, spent_at, spent_date
+                FROM expenses
+                WHERE chat_id=%s AND tg_user_id=%s
+                  AND spent_date BETWEEN %s AND %s
+                  AND (spent_at, id) < (%s, %s)
+                ORDER BY spent_at DESC, id DESC
+                LIMIT %s;
+            """, (chat_id, user_id, start, end, after[0], after[1], limit))
+        else:
+            cur.execute("""
+                SELECT id, amount, currency, main_category, sub_category, note, spent_at, spent_date
+                FROM expenses
+                WHERE chat_id=%s AND tg_user_id=%s
+                  AND spent_date BETWEEN %s AND %s
+                ORDER BY spent_at DESC, id DESC
+                LIMIT %s;
+            """, (chat_id, user_id, start, end, limit))
+        return cur.fetchall()
 
 
-def upsert_override(chat_id: int, user_id: int, main_category: str, currency: str, day: date,
-                    effective_limit: Decimal, reason: str):
+def last_expenses(chat_id: int, user_id: int, n: int = 1) -> List[Dict[str, Any]]:
+    """
+    Последние n записей пользователя (новые сверху), без ограничения периода в прошлое.
+    Записи, датированные будущим, не считаются «последними» — их удаляют по id или фильтром.
+    """
     with db() as conn, conn.cursor() as cur:
         cur.execute("""
-            INSERT INTO daily_overrides(chat_id, tg_user_id, main_category, currency, day, effective_limit, reason)
-            VALUES (%s,%s,%s,%s,%s,%s,%s)
-            ON CONFLICT(chat_id, tg_user_id, main_category, currency, day)
-            DO UPDATE SET effective_limit=EXCLUDED.effective_limit, reason=EXCLUDED.reason, created_at=NOW();
-        """, (chat_id, user_id, main_category, currency, day, effective_limit, reason))
-        conn.commit()
+            SELECT id, amount, currency, main_category, sub_category, note, spent_at, spent_date
+            FROM expenses
+            WHERE chat_id=%s AND tg_user_id=%s AND spent_date <= %s
+            ORDER BY spent_at DESC, id DESC
+            LIMIT %s;
+        """, (chat_id, user_id, today(), n))
+        return cur.fetchall()
 
 
-def get_override(chat_id: int, user_id: int, main_category: str, currency: str, day: date) -> Optional[Dict[str, Any]]:
+def count_expenses(chat_id: int, user_id: int, start: date, end: date) -> int:
+    # количество записей берём из daily_totals.n, строки expenses не читаем
     with db() as conn, conn.cursor() as cur:
         cur.execute("""
-            SELECT effective_limit, reason
-            FROM daily_overrides
-            WHERE chat_id=%s AND tg_user_id=%s AND main_category=%s AND currency=%s AND day=%s;
-        """, (chat_id, user_id, main_category, currency, day))
-        row = cur.fetchone()
-        if not row:
-            return None
-        return {"limit": Decimal(row["effective_limit"]), "reason": row["reason"], "source": "override"}
+            SELECT COALESCE(SUM(n), 0) AS n
+            FROM daily_totals
+            WHERE chat_id=%s AND tg_user_id=%s AND spent_date BETWEEN %s AND %s;
+        """, (chat_id, user_id, start, end))
+        return int(cur.fetchone()["n"])
+
+
+def encode_page_cursor(row: Dict[str, Any]) -> str:
+    return f"{row['spent_at'].isoformat()}|{int(row['id'])}"
+
+
+def decode_page_cursor(cursor: str) -> Tuple[datetime, int]:
+    ts, rid = cursor.rsplit("|", 1)
+    return datetime.fromisoformat(ts), int(rid)
+
+
+def split_full_months(start: date, end: date) -> Tuple[Optional[Tuple[date, date]], List[Tuple[date, date]]]:
+    """
+    Разбивает [start, end] на полные календарные месяцы и неполные края.
+    Возвращает ((первый_месяц, последний_месяц) или None, [(начало, конец) краёв]).
+    """
+    first_full = start if start.day == 1 else month_start(month_start(start) + timedelta(days=32))
+    next_after_end = end + timedelta(days=1)
+    last_full_end = end if next_after_end.day == 1 else month_start(end) - timedelta(days=1)
+
+    if first_full > last_full_end:
+        return None, [(start, end)]
+
+    edges = []
+    if start < first_full:
+        edges.append((start, first_full - timedelta(days=1)))
+    if last_full_end < end:
+        edges.append((last_full_end + timedelta(days=1), end))
+    return (first_full, month_start(last_full_end)), edges
+
+
+def _date_ranges_sql(ranges: List[Tuple[date, date]]) -> Tuple[str, List[date]]:
+    if not ranges:
+        return "FALSE", []
+    sql = " OR ".join("spent_date BETWEEN %s AND %s" for _ in ranges)
+    return f"({sql})", [d for r in ranges for d in r]
 
 
 def sum_expenses(chat_id: int, user_id: int, start: date, end: date,
                  main_category: Optional[str] = None,
                  currency: Optional[str] = None) -> Decimal:
+    # читаем дневные итоги (daily_totals), а не строки расходов: O(дней), а не O(расходов);
+    # полные месяцы длинного периода — из monthly_totals
+    months, edges = split_full_months(start, end)
+    by_cat = bool(main_category and currency)
+    cat_sql = " AND main_category=%s AND currency=%s" if by_cat else ""
+    cat_params = [main_category, currency] if by_cat else []
+
     with db() as conn, conn.cursor() as cur:
-        if main_category and currency:
-            cur.execute("""
+        if not months:
+            cur.execute(f"""
                 SELECT COALESCE(SUM(amount), 0) AS s
-                FROM expenses
-                WHERE chat_id=%s AND tg_user_id=%s
-                  AND spent_date BETWEEN %s AND %s
-                  AND main_category=%s AND currency=%s;
-            """, (chat_id, user_id, start, end, main_category, currency))
-        else:
-            cur.execute("""
-                SELECT COALESCE(SUM(amount), 0) AS s
-                FROM expenses
-                WHERE chat_id=%s AND tg_user_id=%s
+                FROM daily_totals
+                WHERE chat_id=%s AND tg_user_id=%s{cat_sql}
                   AND spent_date BETWEEN %s AND %s;
-            """, (chat_id, user_id, start, end))
+            """, [chat_id, user_id, *cat_params, start, end])
+        else:
+            edges_sql, edges_params = _date_ranges_sql(edges)
+            cur.execute(f"""
+                SELECT COALESCE(SUM(s), 0) AS s
+                FROM (
+                    SELECT SUM(amount) AS s
+                    FROM monthly_totals
+                    WHERE chat_id=%s AND tg_user_id=%s{cat_sql}
+                      AND month BETWEEN %s AND %s
+                    UNION ALL
+                    SELECT SUM(amount) AS s
+                    FROM daily_totals
+                    WHERE chat_id=%s AND tg_user_id=%s{cat_sql}
+                      AND {edges_sql}
+                ) t;
+            """, [chat_id, user_id, *cat_params, months[0], months[1],
+                  chat_id, user_id, *cat_params, *edges_params])
         return Decimal(cur.fetchone()["s"])
 
 
-def add_expense(chat_id: int, user_id: int, amount: Decimal, currency: str,
-                main_category: str, sub_category: str, note: str = "", when: Optional[datetime] = None):
-    when = when or datetime.utcnow()
-    spent_date = when.date()
-    with db() as conn, conn.cursor() as cur:
-        cur.execute("""
-            INSERT INTO expenses(chat_id, tg_user_id, amount, currency, main_category, sub_category, note, spent_at, spent_date)
-            VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s)
-            RETURNING id;
-        """, (chat_id, user_id, amount, currency, main_category, sub_category, note, when, spent_date))
-        rid = cur.fetchone()["id"]
-        conn.commit()
-        return rid
-
-
 def delete_expenses_by_ids(chat_id: int, user_id: int, ids: List[int]) -> int:
     if not ids:
         return 0
@@ -487,51 +1883,180 @@ def delete_expenses_by_ids(chat_id: int, user_id: int, ids: List[int]) -> int:
         return deleted
 
 
-def find_expenses(chat_id: int, user_id: int, start: date, end: date,
-                  main_category: Optional[str] = None,
-                  sub_category: Optional[str] = None) -> List[Dict[str, Any]]:
+def _expense_filter_sql(chat_id: int, user_id: int, start: date, end: date,
+                        main_category: Optional[str], sub_category: Optional[str]) -> Tuple[str, List[Any]]:
+    sql = "chat_id=%s AND tg_user_id=%s AND spent_date BETWEEN %s AND %s"
+    params: List[Any] = [chat_id, user_id, start, end]
+    if main_category:
+        sql += " AND main_category=%s"
+        params.append(main_category)
+        if sub_category:
+            sql += " AND sub_category=%s"
+            params.append(sub_category)
+    return sql, params
+
+
+def match_expenses(chat_id: int, user_id: int, start: date, end: date,
+                   main_category: Optional[str] = None,
+                   sub_category: Optional[str] = None) -> Dict[str, Any]:
+    """Сколько записей подходит под фильтр и максимальный id среди них (снимок для подтверждения)."""
+    where, params = _expense_filter_sql(chat_id, user_id, start, end, main_category, sub_category)
     with db() as conn, conn.cursor() as cur:
-        if main_category and sub_category:
-            cur.execute("""
-                SELECT id, amount, currency, main_category, sub_category, note, spent_at, spent_date
-                FROM expenses
-                WHERE chat_id=%s AND tg_user_id=%s
-                  AND spent_date BETWEEN %s AND %s
-                  AND main_category=%s AND sub_category=%s
-                ORDER BY spent_at DESC;
-            """, (chat_id, user_id, start, end, main_category, sub_category))
-        elif main_category:
-            cur.execute("""
-                SELECT id, amount, currency, main_category, sub_category, note, spent_at, spent_date
-                FROM expenses
-                WHERE chat_id=%s AND tg_user_id=%s
-                  AND spent_date BETWEEN %s AND %s
-                  AND main_category=%s
-                ORDER BY spent_at DESC;
-            """, (chat_id, user_id, start, end, main_category))
-        else:
-            cur.execute("""
-                SELECT id, amount, currency, main_category, sub_category, note, spent_at, spent_date
-                FROM expenses
-                WHERE chat_id=%s AND tg_user_id=%s
-                  AND spent_date BETWEEN %s AND %s
-                ORDER BY spent_at DESC;
-            """, (chat_id, user_id, start, end))
-        return cur.fetchall()
+        cur.execute(f"SELECT COUNT(*) AS n, MAX(id) AS max_id FROM expenses WHERE {where};", params)
+        row = cur.fetchone()
+        return {"count": int(row["n"]), "max_id": int(row["max_id"]) if row["max_id"] is not None else None}
+
+
+def delete_expenses_by_filter(chat_id: int, user_id: int, start: date, end: date,
+                              main_category: Optional[str] = None,
+                              sub_category: Optional[str] = None,
+                              max_id: Optional[int] = None) -> List[int]:
+    """
+    Удаляет все записи под фильтром одним DELETE.
+    max_id — снимок из match_expenses: добавленные после подтверждения записи не удаляются.
+    Возвращает id удалённых.
+    """
+    where, params = _expense_filter_sql(chat_id, user_id, start, end, main_category, sub_category)
+    if max_id is not None:
+        where += " AND id <= %s"
+        params.append(max_id)
+    with db() as conn, conn.cursor() as cur:
+        cur.execute(f"DELETE FROM expenses WHERE {where} RETURNING id;", params)
+        ids = [int(r["id"]) for r in cur.fetchall()]
+        conn.commit()
+        return ids
 
 
 def breakdown_main_sub(chat_id: int, user_id: int, start: date, end: date) -> List[Dict[str, Any]]:
+    months, edges = split_full_months(start, end)
     with db() as conn, conn.cursor() as cur:
-        cur.execute("""
+        if not months:
+            cur.execute("""
+                SELECT main_category, sub_category, currency, COALESCE(SUM(amount), 0) AS spent
+                FROM expenses
+                WHERE chat_id=%s AND tg_user_id=%s AND spent_date BETWEEN %s AND %s
+                GROUP BY main_category, sub_category, currency
+                ORDER BY spent DESC;
+            """, (chat_id, user_id, start, end))
+            return cur.fetchall()
+
+        # полные месяцы — из monthly_totals, неполные края — из строк expenses
+        edges_sql, edges_params = _date_ranges_sql(edges)
+        cur.execute(f"""
             SELECT main_category, sub_category, currency, COALESCE(SUM(amount), 0) AS spent
-            FROM expenses
-            WHERE chat_id=%s AND tg_user_id=%s AND spent_date BETWEEN %s AND %s
+            FROM (
+                SELECT main_category, sub_category, currency, amount
+                FROM monthly_totals
+                WHERE chat_id=%s AND tg_user_id=%s AND month BETWEEN %s AND %s
+                UNION ALL
+                SELECT COALESCE(main_category, ''), COALESCE(sub_category, ''), COALESCE(currency, ''), amount
+                FROM expenses
+                WHERE chat_id=%s AND tg_user_id=%s AND {edges_sql}
+            ) t
             GROUP BY main_category, sub_category, currency
             ORDER BY spent DESC;
-        """, (chat_id, user_id, start, end))
+        """, [chat_id, user_id, months[0], months[1], chat_id, user_id, *edges_params])
         return cur.fetchall()
 
 
+# =========================
+# History retention
+# =========================
+
+# bot_meta: начало последнего успешного прогона prune_history (время БД)
+PRUNE_SINCE_KEY = "convo_prune:since"
+
+PRUNE_STATS: Dict[str, Any] = {
+    "runs": 0,
+    "deleted_total": 0,
+    "last_deleted": 0,
+    "last_seconds": 0.0,
+}
+
+
+def prune_history(keep: int = CONVO_KEEP_MESSAGES, max_age_days: int = CONVO_MAX_AGE_DAYS,
+                  batch: int = CONVO_PRUNE_BATCH) -> int:
+    """
+    Удаляет из convo_messages всё, кроме последних keep сообщений каждого (chat, user),
+    и (если max_age_days > 0) сообщения старше max_age_days.
+    Проверяются только чаты, активные (known_chats.last_seen) с прошлого прогона: у остальных новых
+    сообщений нет, а до границы возраста их сообщения дочищены прошлым прогоном. При max_age_days > 0
+    окно расширяется на max_age_days назад; запас TOUCH_FLUSH_INTERVAL — на ещё не записанные last_seen.
+    Первый прогон (метки в bot_meta нет) — по всей таблице.
+    Найденные (chat, user) чистятся по индексу convo_messages_idx: граница — keep-е сообщение с конца.
+    Пачками по batch строк, каждая пачка — своя транзакция. Возвращает число удалённых строк.
+    """
+    t0 = time.monotonic()
+    last_run = get_meta(PRUNE_SINCE_KEY)
+    with db() as conn, conn.cursor() as cur:
+        cur.execute("SELECT NOW()::timestamp AS now;")
+        started = cur.fetchone()["now"]
+        if last_run is None:
+            cur.execute("""
+                SELECT chat_id, tg_user_id
+                FROM convo_messages
+                GROUP BY chat_id, tg_user_id
+                HAVING COUNT(*) > %(keep)s
+                    OR (%(age)s > 0 AND MIN(created_at) < NOW() - %(age)s * INTERVAL '1 day');
+            """, {"keep": keep, "age": max_age_days})
+        else:
+            since = (datetime.fromisoformat(last_run) - timedelta(days=max(max_age_days, 0))
+                     - timedelta(seconds=2 * TOUCH_FLUSH_INTERVAL))
+            cur.execute("""
+                SELECT m.chat_id, m.tg_user_id
+                FROM known_chats k
+                JOIN convo_messages m ON m.chat_id = k.chat_id
+                WHERE k.last_seen >= %(since)s
+                GROUP BY m.chat_id, m.tg_user_id
+                HAVING COUNT(*) > %(keep)s
+                    OR (%(age)s > 0 AND MIN(m.created_at) < NOW() - %(age)s * INTERVAL '1 day');
+            """, {"since": since, "keep": keep, "age": max_age_days})
+        keys = [(int(r["chat_id"]), int(r["tg_user_id"])) for r in cur.fetchall()]
+
+    deleted = 0
+    for chat_id, user_id in keys:
+        params = {"chat": chat_id, "user": user_id, "keep": keep, "age": max_age_days, "batch": batch}
+        while True:
+            with db() as conn, conn.cursor() as cur:
+                cur.execute("""
+                    WITH edge AS (
+                        SELECT created_at, id
+                        FROM convo_messages
+                        WHERE chat_id = %(chat)s AND tg_user_id = %(user)s
+                        ORDER BY created_at DESC, id DESC
+                        OFFSET %(keep)s
+                        LIMIT 1
+                    )
+                    DELETE FROM convo_messages
+                    WHERE id IN (
+                        SELECT m.id
+                        FROM convo_messages m
+                        LEFT JOIN edge ON TRUE
+                        WHERE m.chat_id = %(chat)s AND m.tg_user_id = %(user)s
+                          AND ((m.created_at, m.id) <= (edge.created_at, edge.id)
+                               OR (%(age)s > 0 AND m.created_at < NOW() - %(age)s * INTERVAL '1 day'))
+                        LIMIT %(batch)s
+                    );
+                """, params)
+                n = cur.rowcount
+            deleted += n
+            if n < batch:
+                break
+
+    set_meta(PRUNE_SINCE_KEY, started.isoformat())
+    PRUNE_STATS["runs"] += 1
+    PRUNE_STATS["deleted_total"] += deleted
+    PRUNE_STATS["last_deleted"] = deleted
+    PRUNE_STATS["last_seconds"] = round(time.monotonic() - t0, 3)
+    if deleted:
+        logger.info("convo_messages pruned: %s rows in %ss", deleted, PRUNE_STATS["last_seconds"])
+    return deleted
+
+
+async def history_prune_job(context: ContextTypes.DEFAULT_TYPE):
+    await run_db(prune_history)
+
+
 # =========================
 # Dates
 # =========================
@@ -559,73 +2084,55 @@ def parse_ymd(s: str) -> date:
 # Carryover logic (остаток переносится / перерасход уменьшает)
 # =========================
 
-def get_effective_daily_limit(chat_id: int, user_id: int, main_category: str, currency: str, day: date) -> Optional[Dict[str, Any]]:
-    ovr = get_override(chat_id, user_id, main_category, currency, day)
-    if ovr:
-        return ovr
-    base = get_budget_base(chat_id, user_id, main_category, currency)
-    if base and base.get("daily_limit") is not None:
-        return {"limit": Decimal(base["daily_limit"]), "reason": "базовый дневной бюджет", "source": "base"}
-    return None
+def _rollover_from_row(row: Optional[Dict[str, Any]], prefix: str = "") -> Optional[Dict[str, Any]]:
+    if not row or row[f"{prefix}reason"] is None:
+        return None
+    return {
+        "yesterday_limit": str(row[f"{prefix}yesterday_limit"]),
+        "yesterday_spent": str(row[f"{prefix}yesterday_spent"]),
+        "delta": str(row[f"{prefix}delta"]),
+        "today_limit": str(row[f"{prefix}today_limit"]),
+        "reason": row[f"{prefix}reason"]
+    }
 
 
 def ensure_daily_rollover_for_today(chat_id: int, user_id: int, main_category: str, currency: str, day: date) -> Optional[Dict[str, Any]]:
     """
     Если на day (сегодня) override ещё не создан — создаём его, учитывая вчерашний результат.
     Это обеспечивает перенос остатка: если вчера был лимит 350к и потратил 100к — +250к к сегодняшнему лимиту.
+    Считает серверная функция budget_rollover (одним запросом); если пользователь молчал несколько дней,
+    она дописывает overrides за все пропущенные дни, перенос не теряется.
     """
-    base = get_budget_base(chat_id, user_id, main_category, currency)
-    if not base or base.get("daily_limit") is None:
-        return None
-
-    # если уже есть override на today — ничего не делаем
-    if get_override(chat_id, user_id, main_category, currency, day):
-        return None
-
-    base_daily = Decimal(base["daily_limit"])
-    yesterday = day - timedelta(days=1)
-
-    eff_y = get_effective_daily_limit(chat_id, user_id, main_category, currency, yesterday)
-    yesterday_limit = Decimal(eff_y["limit"]) if eff_y else base_daily
-
-    yesterday_spent = sum_expenses(chat_id, user_id, yesterday, yesterday, main_category=main_category, currency=currency)
+    with db() as conn, conn.cursor() as cur:
+        cur.execute("SELECT * FROM budget_rollover(%s, %s, %s, %s, %s);",
+                    (chat_id, user_id, main_category, currency, day))
+        row = cur.fetchone()
+        conn.commit()
+    return _rollover_from_row(row)
 
-    delta = yesterday_limit - yesterday_spent  # + остаток, - перерасход
-    today_limit = base_daily + delta
-    if today_limit < 0:
-        today_limit = Decimal("0")
 
-    if delta == 0:
-        reason = "Переноса нет: вчера потрачено ровно по дневному бюджету."
-    elif delta > 0:
-        reason = f"Перенос остатка {delta} {currency} со вчера."
+def budget_info_from_status(st: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Остатки и предупреждения по строке статуса (колонки серверной budget_status): override на день,
+    базовый бюджет, потрачено за день и с начала месяца.
+    """
+    # override на день, иначе базовый дневной бюджет
+    if st["override_limit"] is not None:
+        d_limit = Decimal(st["override_limit"])
+        d_reason = st["override_reason"]
+    elif st["daily_limit"] is not None:
+        d_limit = Decimal(st["daily_limit"])
+        d_reason = "базовый дневной бюджет"
     else:
-        reason = f"Перенос перерасхода {abs(delta)} {currency} со вчера."
-
-    upsert_override(chat_id, user_id, main_category, currency, day, today_limit, reason)
+        d_limit = None
+        d_reason = None
 
-    return {
-        "yesterday_limit": str(yesterday_limit),
-        "yesterday_spent": str(yesterday_spent),
-        "delta": str(delta),
-        "today_limit": str(today_limit),
-        "reason": reason
-    }
-
-
-def calc_left_and_warn(chat_id: int, user_id: int, main_category: str, currency: str, day: date) -> Dict[str, Any]:
-    eff = get_effective_daily_limit(chat_id, user_id, main_category, currency, day)
-    d_limit = eff["limit"] if eff else None
-    d_reason = eff["reason"] if eff else None
-
-    d_spent = sum_expenses(chat_id, user_id, day, day, main_category=main_category, currency=currency)
+    d_spent = Decimal(st["day_spent"])
     d_left = (d_limit - d_spent) if d_limit is not None else None
     d_warn = bool(d_limit is not None and d_limit > 0 and d_left is not None and (d_left / d_limit) < Decimal("0.10"))
 
-    base = get_budget_base(chat_id, user_id, main_category, currency) or {}
-    m_limit = Decimal(base["monthly_limit"]) if base.get("monthly_limit") is not None else None
-    ms = month_start(day)
-    m_spent = sum_expenses(chat_id, user_id, ms, day, main_category=main_category, currency=currency)
+    m_limit = Decimal(st["monthly_limit"]) if st["monthly_limit"] is not None else None
+    m_spent = Decimal(st["month_spent"])
     m_left = (m_limit - m_spent) if m_limit is not None else None
     m_warn = bool(m_limit is not None and m_limit > 0 and m_left is not None and (m_left / m_limit) < Decimal("0.10"))
 
@@ -646,6 +2153,175 @@ def calc_left_and_warn(chat_id: int, user_id: int, main_category: str, currency:
     }
 
 
+def record_expense(chat_id: int, user_id: int, amount: Decimal, currency: str,
+                   main_category: str, sub_category: str, note: str = "",
+                   when: Optional[datetime] = None) -> Tuple[int, Optional[Dict[str, Any]], Dict[str, Any]]:
+    """
+    Записать расход одним вызовом серверной функции record_expense:
+    rollover на день расхода + INSERT + статус бюджета, атомарно.
+    Возвращает (id, rollover как у ensure_daily_rollover_for_today, budget_info из budget_info_from_status).
+    """
+    # spent_at и spent_date — от одного момента: spent_at хранится в UTC, как во всех прежних строках,
+    # spent_date — локальный день этого момента (как today()). when без tzinfo — локальное время.
+    moment = (when or datetime.now()).astimezone(timezone.utc)
+    spent_at = moment.replace(tzinfo=None)
+    day = moment.astimezone().date()
+    with db() as conn, conn.cursor() as cur:
+        cur.execute("SELECT * FROM record_expense(%s, %s, %s, %s, %s, %s, %s, %s, %s);",
+                    (chat_id, user_id, amount, currency, main_category, sub_category, note, spent_at, day))
+        row = cur.fetchone()
+        conn.commit()
+    return int(row["expense_id"]), _rollover_from_row(row, "roll_"), budget_info_from_status(row)
+
+
+ROLLOVER_STATS: Dict[str, Any] = {
+    "runs": 0,
+    "last_day": None,
+    "last_bulk": 0,
+    "last_catchup": 0,
+    "last_seconds": 0.0,
+    "dirty_keys": 0,
+    "dirty_changed": 0,
+    "dirty_failed": 0,
+}
+
+
+def precompute_rollovers(day: date) -> Tuple[int, int]:
+    """
+    Создаёт overrides на day для всех бюджетов с дневным лимитом, чтобы запросы пользователей их только читали.
+    Обычный случай (override на вчера есть) — один INSERT ... SELECT по вчерашним daily_totals;
+    остальные (пропуски, новые бюджеты) догоняются через budget_rollover.
+    Возвращает (создано пачкой, создано догоном).
+    """
+    t0 = time.monotonic()
+    with db() as conn, conn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO daily_overrides(chat_id, tg_user_id, main_category, currency, day, effective_limit, reason)
+            SELECT b.chat_id, b.tg_user_id, b.main_category, b.currency, %(day)s,
+                   GREATEST(b.daily_limit + (y.effective_limit - y.spent), 0),
+                   CASE
+                       WHEN y.effective_limit - y.spent = 0 THEN 'Переноса нет: вчера потрачено ровно по дневному бюджету.'
+                       WHEN y.effective_limit - y.spent > 0 THEN format('Перенос остатка %%s %%s со вчера.', y.effective_limit - y.spent, b.currency)
+                       ELSE format('Перенос перерасхода %%s %%s со вчера.', abs(y.effective_limit - y.spent), b.currency)
+                   END
+            FROM budgets b
+            CROSS JOIN LATERAL (
+                SELECT o.effective_limit, COALESCE(t.amount, 0) AS spent
+                FROM daily_overrides o
+                LEFT JOIN daily_totals t
+                  ON t.chat_id = o.chat_id AND t.tg_user_id = o.tg_user_id AND t.main_category = o.main_category
+                 AND t.currency = o.currency AND t.spent_date = o.day
+                WHERE o.chat_id = b.chat_id AND o.tg_user_id = b.tg_user_id AND o.main_category = b.main_category
+                  AND o.currency = b.currency AND o.day = %(day)s::date - 1
+            ) y
+            WHERE b.daily_limit IS NOT NULL AND b.main_category IS NOT NULL
+            ON CONFLICT (chat_id, tg_user_id, main_category, currency, day) DO NOTHING;
+        """, {"day": day})
+        bulk = cur.rowcount
+
+        cur.execute("""
+            SELECT COUNT(r.*) AS n
+            FROM budgets b
+            CROSS JOIN LATERAL budget_rollover(b.chat_id, b.tg_user_id, b.main_category, b.currency, %(day)s) r
+            WHERE b.daily_limit IS NOT NULL AND b.main_category IS NOT NULL
+              AND NOT EXISTS (
+                  SELECT 1 FROM daily_overrides o
+                  WHERE o.chat_id = b.chat_id AND o.tg_user_id = b.tg_user_id AND o.main_category = b.main_category
+                    AND o.currency = b.currency AND o.day = %(day)s
+              );
+        """, {"day": day})
+        catchup = int(cur.fetchone()["n"])
+        conn.commit()
+
+    ROLLOVER_STATS["runs"] += 1
+    ROLLOVER_STATS["last_day"] = day.isoformat()
+    ROLLOVER_STATS["last_bulk"] = bulk
+    ROLLOVER_STATS["last_catchup"] = catchup
+    ROLLOVER_STATS["last_seconds"] = round(time.monotonic() - t0, 3)
+    logger.info("rollovers for %s: %s bulk, %s catch-up in %ss", day, bulk, catchup, ROLLOVER_STATS["last_seconds"])
+    return bulk, catchup
+
+
+def rollover_job_time() -> dtime:
+    hh, _, mm = ROLLOVER_JOB_TIME.partition(":")
+    # today() — локальная дата сервера, поэтому и время запуска локальное
+    return dtime(int(hh), int(mm or 0), tzinfo=datetime.now().astimezone().tzinfo)
+
+
+async def rollover_job(context: ContextTypes.DEFAULT_TYPE):
+    await run_db(precompute_rollovers, today())
+
+
+def recompute_dirty_rollovers(batch: int = ROLLOVER_DIRTY_BATCH) -> Tuple[int, int]:
+    """
+    Пересчитывает overrides по ключам из rollover_dirty (с from_day до последнего посчитанного дня).
+    Пачками по batch ключей, каждая пачка — своя транзакция: ключи забираются DELETE ... SKIP LOCKED.
+    Каждый ключ — в своём SAVEPOINT: если пересчёт падает, ключ возвращается в конец очереди
+    с attempts+1 и текстом ошибки, остальные ключи пачки обрабатываются.
+    За прогон берутся только ключи, отмеченные до его начала: упавший ключ повторяется на следующем
+    тике job, а не тут же (одна временная ошибка не съедает все попытки). Пачка без единого успеха
+    завершает прогон.
+    Возвращает (ключей обработано, overrides изменено).
+    """
+    keys = changed = failed = 0
+    with db() as conn, conn.cursor() as cur:
+        cur.execute("SELECT NOW()::timestamp AS now;")
+        started = cur.fetchone()["now"]
+    while True:
+        ok = 0
+        with db() as conn, conn.cursor() as cur:
+            cur.execute("""
+                DELETE FROM rollover_dirty d
+                WHERE (d.chat_id, d.tg_user_id, d.main_category, d.currency) IN (
+                    SELECT chat_id, tg_user_id, main_category, currency
+                    FROM rollover_dirty
+                    WHERE attempts < %s AND updated_at < %s
+                    ORDER BY updated_at
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING d.chat_id, d.tg_user_id, d.main_category, d.currency, d.from_day, d.attempts;
+            """, (ROLLOVER_DIRTY_MAX_ATTEMPTS, started, batch))
+            picked = cur.fetchall()
+
+            for k in picked:
+                key = (k["chat_id"], k["tg_user_id"], k["main_category"], k["currency"])
+                cur.execute("SAVEPOINT dirty_key;")
+                try:
+                    cur.execute("SELECT rollover_recompute(%s, %s, %s, %s, %s) AS n;", (*key, k["from_day"]))
+                    changed += int(cur.fetchone()["n"])
+                    cur.execute("RELEASE SAVEPOINT dirty_key;")
+                    ok += 1
+                except psycopg2.Error as e:
+                    cur.execute("ROLLBACK TO SAVEPOINT dirty_key;")
+                    failed += 1
+                    logger.error("rollover recompute failed for %s: %s", key, e)
+                    cur.execute("""
+                        INSERT INTO rollover_dirty(chat_id, tg_user_id, main_category, currency, from_day,
+                                                   attempts, last_error, updated_at)
+                        VALUES (%s, %s, %s, %s, %s, %s, %s, NOW())
+                        ON CONFLICT (chat_id, tg_user_id, main_category, currency)
+                        DO UPDATE SET from_day = LEAST(rollover_dirty.from_day, EXCLUDED.from_day),
+                                      attempts = EXCLUDED.attempts, last_error = EXCLUDED.last_error,
+                                      updated_at = NOW();
+                    """, (*key, k["from_day"], int(k["attempts"]) + 1, str(e)[:500]))
+            conn.commit()
+        keys += ok
+        if len(picked) < batch or not ok:
+            break
+
+    ROLLOVER_STATS["dirty_keys"] += keys
+    ROLLOVER_STATS["dirty_changed"] += changed
+    ROLLOVER_STATS["dirty_failed"] += failed
+    if keys or failed:
+        logger.info("rollover recompute: %s keys, %s overrides changed, %s failed", keys, changed, failed)
+    return keys, changed
+
+
+async def rollover_dirty_job(context: ContextTypes.DEFAULT_TYPE):
+    await run_db(recompute_dirty_rollovers)
+
+
 # =========================
 # Telegram helpers
 # =========================
@@ -674,11 +2350,19 @@ def extract_bot_mention(text: str, entities: Optional[List[MessageEntity]], bot_
     return False
 
 
+_WS_RE = re.compile(r"\s+")
+
+
+@functools.lru_cache(maxsize=8)
+def _mention_re(bot_username: str) -> "re.Pattern[str]":
+    return re.compile(rf"@{re.escape(bot_username)}\b", re.IGNORECASE)
+
+
 def strip_bot_mention(text: str, bot_username: str) -> str:
     if not text:
         return text
-    t = re.sub(rf"@{re.escape(bot_username)}\b", "", text, flags=re.IGNORECASE).strip()
-    t = re.sub(r"\s+", " ", t)
+    t = _mention_re(bot_username).sub("", text).strip()
+    t = _WS_RE.sub(" ", t)
     return t
 
 
@@ -757,7 +2441,8 @@ PLANNER = """
       "action": "get_history",
       "start_date": "YYYY-MM-DD",
       "end_date": "YYYY-MM-DD",
-      "group_by": "none|day|main_sub"
+      "group_by": "none|day|main_sub",
+      "page": "next (опционально: следующая страница прошлого запроса истории, даты тогда не нужны)"
     },
     {
       "action": "get_categories",
@@ -778,6 +2463,7 @@ PLANNER = """
       "action": "delete_expense",
       "mode": "last|by_id|filter",
       "id": 123,
+      "count": 1,
       "start_date": "YYYY-MM-DD",
       "end_date": "YYYY-MM-DD",
       "main_category": "еда (опционально)",
@@ -786,6 +2472,7 @@ PLANNER = """
   ],
   "assistant_message": "если уместно — короткое пояснение, иначе пусто"
 }
+count в delete_expense (mode=last) — число: сколько последних записей удалить.
 
 2) clarify:
 {
@@ -795,22 +2482,180 @@ PLANNER = """
 }
 """.strip()
 
-RESPONDER = f"""
-Верни ТОЛЬКО JSON:
-{{
-  "type":"final",
-  "reply":"готовый ответ пользователю на русском",
-  "new_summary":"обновлённое краткое резюме диалога (до {MAX_SUMMARY_CHARS} символов)"
-}}
+RESPONDER = f"""
+Верни ТОЛЬКО JSON:
+{{
+  "type":"final",
+  "reply":"готовый ответ пользователю на русском",
+  "new_summary":"обновлённое краткое резюме диалога (до {MAX_SUMMARY_CHARS} символов)"
+}}
+
+Требования к ответу:
+- опирайся на результаты действий (DATA или ответы инструментов)
+- при add_expense: покажи остаток дневного и месячного бюджета по main_category (если задан)
+- если осталось <10% по дневному или месячному бюджету — предупреди
+- учитывай перенос: если вчера была недотрата — сегодня дневной лимит больше; если перерасход — меньше
+""".strip()
+
+
+TOOLS_PROMPT = """
+Для действий с расходами и бюджетами вызывай инструменты (можно несколько сразу).
+Если не хватает данных — не вызывай инструменты, задай один уточняющий вопрос в поле reply.
+Когда инструменты не нужны или их результаты уже получены — ответь так:
+""".strip()
+
+
+def _input_msg(role: str, text: str) -> Dict[str, Any]:
+    return {"role": role, "content": [{"type": "input_text", "text": text}]}
+
+
+# Общий префикс всех текстовых вызовов (план, ответ, tools): роль, категории, правила. Собирается один раз
+# и не меняется ни на байт, чтобы провайдер кэшировал его между вызовами.
+STATIC_PREFIX: Tuple[Dict[str, Any], ...] = (_input_msg("system", SYSTEM),)
+
+# За ним — формат вывода своего этапа (тоже неизменный); движок tools не видит формат JSON-плана.
+# Всё изменчивое (summary, история, запрос) идёт после.
+PHASE_PREFIX: Dict[str, Tuple[Dict[str, Any], ...]] = {
+    "plan": STATIC_PREFIX + (_input_msg("system", PLANNER),),
+    "final": STATIC_PREFIX + (_input_msg("system", RESPONDER),),
+    "tools": STATIC_PREFIX + (_input_msg("system", TOOLS_PROMPT + "\n\n" + RESPONDER),),
+}
+
+
+OPENAI_RESPONSES_URL = "https://api.openai.com/v1/responses"
+
+# таймауты по типу запроса: connect короткий, read — сколько модель может думать
+OPENAI_TIMEOUT_TEXT = httpx.Timeout(35, connect=OPENAI_CONNECT_TIMEOUT)
+OPENAI_TIMEOUT_VISION = httpx.Timeout(45, connect=OPENAI_CONNECT_TIMEOUT)
+
+HTTP_STATS: Dict[str, Any] = {
+    "requests": 0,
+    "new_connections": 0,
+    "errors": 0,
+    "http2": 0,
+}
+
+_HTTP_CLIENT: Optional[httpx.AsyncClient] = None
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def start_http_client() -> httpx.AsyncClient:
+    global _HTTP_CLIENT
+    if _HTTP_CLIENT is None or _HTTP_CLIENT.is_closed:
+        http2 = OPENAI_HTTP2 and _http2_available()
+        _HTTP_CLIENT = httpx.AsyncClient(
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=OPENAI_MAX_CONNECTIONS,
+                max_keepalive_connections=OPENAI_MAX_KEEPALIVE,
+                keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY,
+            ),
+            timeout=OPENAI_TIMEOUT_TEXT,
+            headers={"Authorization": f"Bearer {OPENAI_API_KEY}"},
+        )
+        logger.info("OpenAI http client started (http2=%s)", http2)
+    return _HTTP_CLIENT
+
+
+async def close_http_client():
+    global _HTTP_CLIENT
+    if _HTTP_CLIENT is not None:
+        await _HTTP_CLIENT.aclose()
+        _HTTP_CLIENT = None
+
+
+async def _http_trace(event_name: str, info: Dict[str, Any]):
+    # httpcore сообщает об установке нового TCP-соединения; всё остальное — запросы по уже открытым
+    if event_name == "connection.connect_tcp.complete":
+        HTTP_STATS["new_connections"] += 1
+
+
+# по движкам (PLAN_ENGINE): ходы с вызовом LLM, их суммарное время, вызовы API и токены.
+# fallback — ходы движка tools, где пришлось перейти на json: время включает неудачный вызов tools
+LLM_STATS: Dict[str, Dict[str, Any]] = {
+    engine: {"turns": 0, "seconds": 0.0, "calls": 0, "input_tokens": 0, "cached_tokens": 0, "output_tokens": 0}
+    for engine in ("json", "tools", "fallback")
+}
+
+# последние вызовы: сколько входных токенов пришло из кэша префикса и сколько длился вызов
+LLM_CALLS: "deque[Dict[str, Any]]" = deque(maxlen=50)
+
+
+def llm_turn(engine: str, seconds: float):
+    LLM_STATS[engine]["turns"] += 1
+    LLM_STATS[engine]["seconds"] += seconds
+
+
+def _record_usage(engine: str, phase: str, data: Dict[str, Any], seconds: float):
+    st = LLM_STATS[engine]
+    usage = data.get("usage") or {}
+    input_tokens = int(usage.get("input_tokens") or 0)
+    cached = int((usage.get("input_tokens_details") or {}).get("cached_tokens") or 0)
+    output_tokens = int(usage.get("output_tokens") or 0)
+    st["calls"] += 1
+    st["input_tokens"] += input_tokens
+    st["cached_tokens"] += cached
+    st["output_tokens"] += output_tokens
+    LLM_CALLS.append({
+        "engine": engine, "phase": phase, "input_tokens": input_tokens, "cached_tokens": cached,
+        "output_tokens": output_tokens, "seconds": round(seconds, 3),
+    })
+
+
+async def openai_post(payload: Dict[str, Any], timeout: httpx.Timeout,
+                      engine: Optional[str] = None, phase: str = "") -> Optional[Dict[str, Any]]:
+    """POST в Responses API через общий клиент. None — если ошибка (уже залогирована)."""
+    HTTP_STATS["requests"] += 1
+    t0 = time.monotonic()
+    try:
+        r = await start_http_client().post(
+            OPENAI_RESPONSES_URL, json=payload, timeout=timeout, extensions={"trace": _http_trace},
+        )
+    except httpx.HTTPError as e:
+        HTTP_STATS["errors"] += 1
+        logger.error("OpenAI request failed: %r", e)
+        return None
+    if r.http_version == "HTTP/2":
+        HTTP_STATS["http2"] += 1
+    if r.status_code >= 400:
+        HTTP_STATS["errors"] += 1
+        logger.error("OpenAI error %s: %s", r.status_code, r.text[:400])
+        return None
+    data = r.json()
+    if engine:
+        _record_usage(engine, phase, data, time.monotonic() - t0)
+    return data
+
+
+def output_text(data: Dict[str, Any]) -> str:
+    out = ""
+    for item in data.get("output", []):
+        for c in item.get("content") or []:
+            if c.get("type") == "output_text":
+                out += c.get("text", "")
+    return out
+
 
-Требования к ответу:
-- при add_expense: покажи остаток дневного и месячного бюджета по main_category (если задан)
-- если осталось <10% по дневному или месячному бюджету — предупреди
-- учитывай перенос: если вчера была недотрата — сегодня дневной лимит больше; если перерасход — меньше
-""".strip()
+def http_metrics() -> Dict[str, Any]:
+    reqs = HTTP_STATS["requests"]
+    reused = max(reqs - HTTP_STATS["new_connections"], 0)
+    return {
+        **HTTP_STATS,
+        "reused": reused,
+        "reuse_ratio": round(reused / reqs, 3) if reqs else 0.0,
+    }
 
 
-async def openai_json(messages: List[Dict[str, Any]], model: str = OPENAI_MODEL, timeout_s: int = 35) -> Dict[str, Any]:
+async def openai_json(messages: List[Dict[str, Any]], model: str = OPENAI_MODEL,
+                      timeout: httpx.Timeout = OPENAI_TIMEOUT_TEXT, phase: str = "",
+                      engine: str = "json") -> Dict[str, Any]:
     if not OPENAI_API_KEY:
         return {"type": "clarify", "question": "Не задан OPENAI_API_KEY. Добавьте ключ и повторите.", "expected": "period"}
 
@@ -819,20 +2664,11 @@ async def openai_json(messages: List[Dict[str, Any]], model: str = OPENAI_MODEL,
         "input": messages,
         "text": {"format": {"type": "json_object"}},
     }
-    headers = {"Authorization": f"Bearer {OPENAI_API_KEY}", "Content-Type": "application/json"}
-    async with httpx.AsyncClient(timeout=timeout_s) as client:
-        r = await client.post("https://api.openai.com/v1/responses", headers=headers, json=payload)
-        if r.status_code >= 400:
-            logger.error("OpenAI error %s: %s", r.status_code, r.text[:400])
-            return {"type": "clarify", "question": "Не получилось обработать запрос. Повторите короче.", "expected": "period"}
-        data = r.json()
-
-    out = ""
-    for item in data.get("output", []):
-        for c in item.get("content", []):
-            if c.get("type") == "output_text":
-                out += c.get("text", "")
+    data = await openai_post(payload, timeout, engine=engine, phase=phase)
+    if data is None:
+        return {"type": "clarify", "question": "Не получилось обработать запрос. Повторите короче.", "expected": "period"}
 
+    out = output_text(data)
     try:
         return json.loads(out) if out else {"type": "clarify", "question": "Уточните запрос.", "expected": "period"}
     except Exception:
@@ -840,21 +2676,138 @@ async def openai_json(messages: List[Dict[str, Any]], model: str = OPENAI_MODEL,
 
 
 def build_context(summary: str, history: List[Dict[str, str]], user_text: str, phase: str) -> List[Dict[str, Any]]:
-    msgs: List[Dict[str, Any]] = []
-    msgs.append({"role": "system", "content": [{"type": "input_text", "text": SYSTEM}]})
-    msgs.append({"role": "system", "content": [{"type": "input_text", "text": PLANNER if phase == "plan" else RESPONDER}]})
+    msgs: List[Dict[str, Any]] = list(PHASE_PREFIX[phase])
 
     if summary:
-        msgs.append({"role": "system", "content": [{"type": "input_text", "text": f"Краткий контекст:\n{summary}"}]})
+        msgs.append(_input_msg("system", f"Краткий контекст:\n{summary}"))
 
     for h in history:
         role = "user" if h["role"] == "user" else "assistant"
-        msgs.append({"role": role, "content": [{"type": "input_text", "text": h["content"]}]})
+        msgs.append(_input_msg(role, h["content"]))
 
-    msgs.append({"role": "user", "content": [{"type": "input_text", "text": user_text}]})
+    msgs.append(_input_msg("user", user_text))
     return msgs
 
 
+# =========================
+# Tool calling engine (PLAN_ENGINE=tools)
+# =========================
+
+def _tool(name: str, description: str, properties: Dict[str, Any], required: List[str]) -> Dict[str, Any]:
+    return {
+        "type": "function",
+        "name": name,
+        "description": description,
+        "parameters": {"type": "object", "properties": properties, "required": required},
+    }
+
+
+_DATE = {"type": "string", "description": "YYYY-MM-DD"}
+_PERIOD = {"start_date": _DATE, "end_date": _DATE}
+
+# те же действия, что в PLANNER, — аргументы инструмента становятся action плана как есть
+TOOLS: List[Dict[str, Any]] = [
+    _tool("add_expense", "Записать расход", {
+        "amount": {"type": "number"},
+        "currency": {"type": "string"},
+        "main_category": {"type": "string", "description": "еда, транспорт, дом, здоровье, развлечения, подписки, другое"},
+        "sub_category": {"type": "string", "description": "кофе, рестораны, такси, продукты, ..."},
+        "note": {"type": "string"},
+        "spent_date": {"type": "string", "description": "YYYY-MM-DD, если не сегодня"},
+    }, ["amount", "main_category", "sub_category"]),
+    _tool("set_budget", "Поставить дневной и/или месячный бюджет на main_category", {
+        "currency": {"type": "string"},
+        "main_category": {"type": "string"},
+        "daily_limit": {"type": "number"},
+        "monthly_limit": {"type": "number"},
+    }, ["main_category"]),
+    _tool("get_history", "История расходов за период; start_date и end_date обязательны, если не page=next", {
+        **_PERIOD,
+        "group_by": {"type": "string", "enum": ["none", "day", "main_sub"]},
+        "page": {"type": "string", "enum": ["next"], "description": "следующая страница прошлого запроса, даты не нужны"},
+    }, []),
+    _tool("get_categories", "Категории и подкатегории расходов за период", _PERIOD, ["start_date", "end_date"]),
+    _tool("get_stats", "Итоги расходов за период", _PERIOD, ["start_date", "end_date"]),
+    _tool("suggest_savings", "Данные для советов по экономии за период", _PERIOD, ["start_date", "end_date"]),
+    _tool("delete_expense", "Удалить записи (пользователь подтвердит)", {
+        "mode": {"type": "string", "enum": ["last", "by_id", "filter"]},
+        "id": {"type": "integer"},
+        "count": {"type": "integer", "description": "для last: сколько последних записей"},
+        **_PERIOD,
+        "main_category": {"type": "string"},
+        "sub_category": {"type": "string"},
+    }, ["mode"]),
+]
+
+
+def _parse_final(out: str) -> Optional[Dict[str, Any]]:
+    try:
+        obj = json.loads(out) if out else None
+    except Exception:
+        return None
+    return obj if isinstance(obj, dict) and obj.get("reply") else None
+
+
+async def openai_tools_plan(summary: str, history: List[Dict[str, str]], user_text: str) -> Optional[Dict[str, Any]]:
+    """
+    Первый вызов движка tools. Возвращает план ({"type": "plan", "actions", "response_id", "call_ids"})
+    или готовый ответ без действий ({"type": "reply", "reply", "new_summary"}); None — вызвать JSON-планировщик.
+    """
+    if not OPENAI_API_KEY:
+        return None
+    payload = {
+        "model": OPENAI_MODEL,
+        "input": build_context(summary, history, user_text, phase="tools"),
+        "tools": TOOLS,
+        "text": {"format": {"type": "json_object"}},
+    }
+    data = await openai_post(payload, OPENAI_TIMEOUT_TEXT, engine="tools", phase="plan")
+    if data is None:
+        return None
+
+    actions: List[Dict[str, Any]] = []
+    call_ids: List[str] = []
+    for item in data.get("output", []):
+        if item.get("type") != "function_call":
+            continue
+        try:
+            args = json.loads(item.get("arguments") or "{}")
+        except Exception:
+            return None
+        actions.append({**args, "action": item.get("name")})
+        call_ids.append(item.get("call_id"))
+
+    if actions:
+        return {"type": "plan", "actions": actions, "response_id": data.get("id"), "call_ids": call_ids}
+
+    final = _parse_final(output_text(data))
+    if not final:
+        return None
+    return {"type": "reply", "reply": str(final["reply"]).strip(), "new_summary": final.get("new_summary")}
+
+
+async def openai_tools_finish(plan: Dict[str, Any], data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Вернуть результаты execute_plan в диалог (function_call_output) и получить {"reply", "new_summary"}."""
+    results = data.get("results") or []
+    if len(results) != len(plan["call_ids"]):
+        return None
+    payload = {
+        "model": OPENAI_MODEL,
+        "previous_response_id": plan["response_id"],
+        "input": [
+            {"type": "function_call_output", "call_id": call_id, "output": json.dumps(r, ensure_ascii=False, default=str)}
+            for call_id, r in zip(plan["call_ids"], results)
+        ],
+        "tools": TOOLS,
+        "tool_choice": "none",
+        "text": {"format": {"type": "json_object"}},
+    }
+    resp = await openai_post(payload, OPENAI_TIMEOUT_TEXT, engine="tools", phase="final")
+    if resp is None:
+        return None
+    return _parse_final(output_text(resp))
+
+
 # =========================
 # Receipt parsing (photo)
 # =========================
@@ -890,19 +2843,11 @@ async def parse_receipt(image_bytes: bytes) -> Dict[str, Any]:
         ],
         "text": {"format": {"type": "json_object"}},
     }
-    headers = {"Authorization": f"Bearer {OPENAI_API_KEY}", "Content-Type": "application/json"}
-    async with httpx.AsyncClient(timeout=45) as client:
-        r = await client.post("https://api.openai.com/v1/responses", headers=headers, json=payload)
-        if r.status_code >= 400:
-            logger.error("OpenAI vision error %s: %s", r.status_code, r.text[:300])
-            return {"type": "unknown"}
-        data = r.json()
+    data = await openai_post(payload, OPENAI_TIMEOUT_VISION)
+    if data is None:
+        return {"type": "unknown"}
 
-    out = ""
-    for item in data.get("output", []):
-        for c in item.get("content", []):
-            if c.get("type") == "output_text":
-                out += c.get("text", "")
+    out = output_text(data)
 
     try:
         return json.loads(out) if out else {"type": "unknown"}
@@ -910,10 +2855,179 @@ async def parse_receipt(image_bytes: bytes) -> Dict[str, Any]:
         return {"type": "unknown"}
 
 
+# =========================
+# Fast path: простые расходы без LLM
+# =========================
+
+FAST_PATH_STATS: Dict[str, Any] = {
+    "hits": 0,
+    "misses": 0,
+    "planner_calls": 0,
+    "planner_seconds": 0.0,
+    "saved_seconds": 0.0,
+}
+
+# сумма: "12000", "12 000", "1,5", и множитель "к"/"тыс"/"млн" (в т.ч. через пробел)
+_FP_AMOUNT_RE = re.compile(
+    r"(?<![\w.,])(\d{1,3}(?:[ \u00a0]\d{3})+|\d+(?:[.,]\d+)?)\s*"
+    r"(к|k|тыс(?:яч[аи]?)?\.?|млн\.?|миллион(?:а|ов)?)?(?!\w)",
+    re.IGNORECASE,
+)
+_FP_WORD_RE = re.compile(r"[a-zа-яё]+|[$€₽]")
+
+_FP_MULTIPLIERS = (("к", 1000), ("k", 1000), ("тыс", 1000), ("млн", 1_000_000), ("миллион", 1_000_000))
+
+_FP_CURRENCIES = {
+    "сум": "UZS", "сума": "UZS", "сумов": "UZS", "uzs": "UZS",
+    "$": "USD", "usd": "USD", "долл": "USD", "доллар": "USD", "доллара": "USD", "долларов": "USD",
+    "бакс": "USD", "бакса": "USD", "баксов": "USD",
+    "€": "EUR", "eur": "EUR", "евро": "EUR",
+    "₽": "RUB", "rub": "RUB", "руб": "RUB", "рубль": "RUB", "рубля": "RUB", "рублей": "RUB",
+}
+
+_FP_STOPWORDS = {"на", "за", "в", "во"}
+
+# словоформы -> (main_category, sub_category); только целые слова: незнакомая форма уходит планировщику
+_FP_CATEGORY_FORMS: Tuple[Tuple[str, str, str], ...] = (
+    ("кофе капучино латте американо эспрессо", "еда", "кофе"),
+    ("продукты продуктов продуктами", "еда", "продукты"),
+    ("ресторан ресторане ресторана кафе", "еда", "рестораны"),
+    ("обед обеда обедом ужин ужина ужином завтрак завтрака завтраком", "еда", "рестораны"),
+    ("шаурма шаурму шаурмы бургер бургеры бургера пицца пиццу пиццы", "еда", "фастфуд"),
+    ("такси", "транспорт", "такси"),
+    ("метро автобус автобуса", "транспорт", "общественный транспорт"),
+    ("бензин бензина заправка заправку заправки топливо топлива", "транспорт", "топливо"),
+    ("парковка парковку парковки", "транспорт", "парковка"),
+    ("коммуналка коммуналку коммуналки коммунальные", "дом", "коммуналка"),
+    ("интернет интернета", "дом", "интернет"),
+    ("аренда аренду аренды", "дом", "аренда"),
+    ("аптека аптеку аптеке аптеки лекарства лекарство", "здоровье", "аптека"),
+    ("врач врача врачу стоматолог стоматолога стоматологу", "здоровье", "врачи"),
+    ("кино кинотеатр", "развлечения", "кино"),
+    ("бар бара баре", "развлечения", "бары"),
+    ("подписка подписку подписки netflix spotify", "подписки", "подписки"),
+)
+_FP_CATEGORIES: Dict[str, Tuple[str, str]] = {
+    word: (main, sub) for forms, main, sub in _FP_CATEGORY_FORMS for word in forms.split()
+}
+
+
+def _fp_category(word: str) -> Optional[Tuple[str, str]]:
+    return _FP_CATEGORIES.get(word)
+
+
+def fast_parse_expense(text: str) -> Optional[Dict[str, Any]]:
+    """
+    План add_expense для сообщений вида "кофе 12000", "такси 35к", "продукты 1,2 млн сум".
+    Только если разобрано всё: ровно одна сумма, не больше одной валюты, каждое слово — категория,
+    валюта или предлог, и все категории совпадают. Иначе None — решает планировщик.
+    """
+    t = (text or "").strip().lower()
+    if not t or len(t) > 80:
+        return None
+
+    amounts = list(_FP_AMOUNT_RE.finditer(t))
+    if len(amounts) != 1:
+        return None
+    m = amounts[0]
+    # "12.000" — то ли 12, то ли 12000
+    if re.fullmatch(r"\d+[.,]\d{3}", m.group(1)):
+        return None
+    try:
+        amount = Decimal(re.sub(r"[ \u00a0]", "", m.group(1)).replace(",", "."))
+    except Exception:
+        return None
+    suffix = (m.group(2) or "").rstrip(".")
+    for prefix, mult in _FP_MULTIPLIERS:
+        if suffix.startswith(prefix):
+            amount *= mult
+            break
+    if amount <= 0:
+        return None
+
+    currencies = set()
+    cats = set()
+    for w in _FP_WORD_RE.findall(t[:m.start()] + " " + t[m.end():]):
+        if w in _FP_CURRENCIES:
+            currencies.add(_FP_CURRENCIES[w])
+        elif w in _FP_STOPWORDS:
+            continue
+        else:
+            cat = _fp_category(w)
+            if cat is None:
+                return None
+            cats.add(cat)
+    # всё, что не слово (кроме пробелов и пунктуации в конце), — повод отдать LLM
+    rest = _FP_WORD_RE.sub("", t[:m.start()] + " " + t[m.end():])
+    if re.search(r"[^\s.,!]", rest):
+        return None
+    if len(cats) != 1 or len(currencies) > 1:
+        return None
+
+    main_category, sub_category = cats.pop()
+    return {
+        "type": "plan",
+        "source": "fast_path",
+        "actions": [{
+            "action": "add_expense",
+            "amount": str(amount.quantize(Decimal(1)) if amount == amount.to_integral() else amount),
+            "currency": currencies.pop() if currencies else DEFAULT_CURRENCY,
+            "main_category": main_category,
+            "sub_category": sub_category,
+            "note": "",
+        }],
+    }
+
+
+def fast_path_hit():
+    FAST_PATH_STATS["hits"] += 1
+    # экономия — средняя длительность вызова планировщика
+    if FAST_PATH_STATS["planner_calls"]:
+        FAST_PATH_STATS["saved_seconds"] += FAST_PATH_STATS["planner_seconds"] / FAST_PATH_STATS["planner_calls"]
+
+
+def fast_path_miss(planner_seconds: float):
+    FAST_PATH_STATS["misses"] += 1
+    FAST_PATH_STATS["planner_calls"] += 1
+    FAST_PATH_STATS["planner_seconds"] += planner_seconds
+
+
 # =========================
 # Action executor
 # =========================
 
+def parse_count(value: Any, hi: int) -> int:
+    """count от модели: число или строка вида "3 ..."; всё непонятное — 1. Ограничено [1, hi]."""
+    m = re.match(r"\s*(\d+)", str(value if value is not None else ""))
+    return min(max(int(m.group(1)) if m else 1, 1), hi)
+
+
+def parse_period(a: Dict[str, Any]) -> Optional[Tuple[date, date]]:
+    """start_date/end_date из действия; None — если дат нет или они не в формате YYYY-MM-DD."""
+    try:
+        return parse_ymd(str(a["start_date"])), parse_ymd(str(a["end_date"]))
+    except (KeyError, ValueError):
+        return None
+
+
+def parse_delete_filter(a: Dict[str, Any]) -> Dict[str, Any]:
+    """Фильтр delete_expense mode=filter в виде, пригодном для user_states (JSON)."""
+    start = parse_ymd(a["start_date"])
+    end = parse_ymd(a["end_date"])
+    mc = (a.get("main_category") or None)
+    sc = (a.get("sub_category") or None)
+    mc = mc.lower().strip() if isinstance(mc, str) and mc.strip() else None
+    sc = sc.lower().strip() if isinstance(sc, str) and sc.strip() else None
+    return {"start_date": str(start), "end_date": str(end), "main_category": mc, "sub_category": sc}
+
+
+def delete_by_saved_filter(chat_id: int, user_id: int, flt: Dict[str, Any], max_id: Optional[int] = None) -> List[int]:
+    return delete_expenses_by_filter(
+        chat_id, user_id, parse_ymd(flt["start_date"]), parse_ymd(flt["end_date"]),
+        main_category=flt.get("main_category"), sub_category=flt.get("sub_category"), max_id=max_id,
+    )
+
+
 def execute_plan(chat_id: int, user_id: int, plan: Dict[str, Any]) -> Dict[str, Any]:
     actions = plan.get("actions") or []
     if not isinstance(actions, list):
@@ -961,14 +3075,8 @@ def execute_plan(chat_id: int, user_id: int, plan: Dict[str, Any]) -> Dict[str,
                 d = parse_ymd(spent_date_str)
                 when = datetime(d.year, d.month, d.day, 12, 0, 0)
 
-            d = when.date() if when else today()
-
-            # ВАЖНО: rollover применяем ДО записи расхода (чтобы лимит дня был корректным)
-            roll = ensure_daily_rollover_for_today(chat_id, user_id, main_category, currency, d)
-
-            rid = add_expense(chat_id, user_id, amount, currency, main_category, sub_category, note, when=when)
-
-            budget_info = calc_left_and_warn(chat_id, user_id, main_category, currency, d)
+            # rollover (ДО записи расхода), запись и статус бюджета — одним вызовом на сервере
+            rid, roll, budget_info = record_expense(chat_id, user_id, amount, currency, main_category, sub_category, note, when=when)
 
             data["results"].append({
                 "action": "add_expense",
@@ -983,14 +3091,47 @@ def execute_plan(chat_id: int, user_id: int, plan: Dict[str, Any]) -> Dict[str,
             })
 
         elif act == "get_history":
-            start = parse_ymd(a["start_date"])
-            end = parse_ymd(a["end_date"])
-            group_by = str(a.get("group_by") or "none").strip()
-
-            rows = find_expenses(chat_id, user_id, start, end)
+            # "page": "next" — продолжение прошлого запроса истории, параметры берём из user_states
+            if str(a.get("page") or "").strip() == "next":
+                st = get_state(chat_id, user_id) or {}
+                if st.get("kind") != "history_page":
+                    data["results"].append({"action": "get_history", "error": "no_previous_page"})
+                    continue
+                start = parse_ymd(st["start_date"])
+                end = parse_ymd(st["end_date"])
+                group_by = str(st.get("group_by") or "none")
+                after = decode_page_cursor(st["cursor"])
+                page_no = int(st.get("page_no") or 1) + 1
+            else:
+                period = parse_period(a)
+                if period is None:
+                    data["results"].append({"action": "get_history", "error": "missing_dates"})
+                    continue
+                start, end = period
+                group_by = str(a.get("group_by") or "none").strip()
+                after = None
+                page_no = 1
+
+            # +1 строка — чтобы понять, есть ли следующая страница
+            rows = find_expenses_page(chat_id, user_id, start, end, after=after, limit=HISTORY_PAGE_SIZE + 1)
+            has_more = len(rows) > HISTORY_PAGE_SIZE
+            rows = rows[:HISTORY_PAGE_SIZE]
             total = sum_expenses(chat_id, user_id, start, end)
-
-            cats = breakdown_main_sub(chat_id, user_id, start, end) if group_by == "main_sub" else None
+            count = count_expenses(chat_id, user_id, start, end)
+
+            cats = breakdown_main_sub(chat_id, user_id, start, end) if group_by == "main_sub" and page_no == 1 else None
+
+            if has_more:
+                set_state(chat_id, user_id, {
+                    "kind": "history_page",
+                    "start_date": str(start),
+                    "end_date": str(end),
+                    "group_by": group_by,
+                    "cursor": encode_page_cursor(rows[-1]),
+                    "page_no": page_no,
+                })
+            else:
+                clear_state(chat_id, user_id)
 
             data["results"].append({
                 "action": "get_history",
@@ -998,14 +3139,19 @@ def execute_plan(chat_id: int, user_id: int, plan: Dict[str, Any]) -> Dict[str,
                 "end_date": str(end),
                 "group_by": group_by,
                 "total": str(total),
-                "rows_count": len(rows),
-                "rows_preview": rows[:25],
+                "rows_count": count,
+                "page": page_no,
+                "has_more": has_more,
+                "rows_preview": rows,
                 "by_main_sub": cats[:60] if cats else None
             })
 
         elif act == "get_categories":
-            start = parse_ymd(a["start_date"])
-            end = parse_ymd(a["end_date"])
+            period = parse_period(a)
+            if period is None:
+                data["results"].append({"action": act, "error": "missing_dates"})
+                continue
+            start, end = period
             cats = breakdown_main_sub(chat_id, user_id, start, end)
             data["results"].append({
                 "action": "get_categories",
@@ -1015,8 +3161,11 @@ def execute_plan(chat_id: int, user_id: int, plan: Dict[str, Any]) -> Dict[str,
             })
 
         elif act == "get_stats":
-            start = parse_ymd(a["start_date"])
-            end = parse_ymd(a["end_date"])
+            period = parse_period(a)
+            if period is None:
+                data["results"].append({"action": act, "error": "missing_dates"})
+                continue
+            start, end = period
             cats = breakdown_main_sub(chat_id, user_id, start, end)
             total = sum_expenses(chat_id, user_id, start, end)
             data["results"].append({
@@ -1028,8 +3177,11 @@ def execute_plan(chat_id: int, user_id: int, plan: Dict[str, Any]) -> Dict[str,
             })
 
         elif act == "suggest_savings":
-            start = parse_ymd(a["start_date"])
-            end = parse_ymd(a["end_date"])
+            period = parse_period(a)
+            if period is None:
+                data["results"].append({"action": act, "error": "missing_dates"})
+                continue
+            start, end = period
             cats = breakdown_main_sub(chat_id, user_id, start, end)
             total = sum_expenses(chat_id, user_id, start, end)
             data["results"].append({
@@ -1048,28 +3200,17 @@ def execute_plan(chat_id: int, user_id: int, plan: Dict[str, Any]) -> Dict[str,
                 data["results"].append({"action": "delete_expense", "mode": mode, "deleted": deleted, "ids": [rid]})
 
             elif mode == "last":
-                rows = find_expenses(chat_id, user_id, today() - timedelta(days=3650), today())
-                if rows:
-                    rid = int(rows[0]["id"])
-                    deleted = delete_expenses_by_ids(chat_id, user_id, [rid])
-                    data["results"].append({"action": "delete_expense", "mode": mode, "deleted": deleted, "ids": [rid]})
-                else:
-                    data["results"].append({"action": "delete_expense", "mode": mode, "deleted": 0, "ids": []})
+                count = parse_count(a.get("count"), UNDO_MAX)
+                ids = [int(r["id"]) for r in last_expenses(chat_id, user_id, count)]
+                deleted = delete_expenses_by_ids(chat_id, user_id, ids)
+                data["results"].append({"action": "delete_expense", "mode": mode, "deleted": deleted, "ids": ids})
 
             elif mode == "filter":
-                start = parse_ymd(a["start_date"])
-                end = parse_ymd(a["end_date"])
-                mc = (a.get("main_category") or None)
-                sc = (a.get("sub_category") or None)
-                mc = mc.lower().strip() if isinstance(mc, str) and mc.strip() else None
-                sc = sc.lower().strip() if isinstance(sc, str) and sc.strip() else None
-                rows = find_expenses(chat_id, user_id, start, end, main_category=mc, sub_category=sc)
-                ids = [int(r["id"]) for r in rows]
-                deleted = delete_expenses_by_ids(chat_id, user_id, ids)
+                ids = delete_by_saved_filter(chat_id, user_id, parse_delete_filter(a))
                 data["results"].append({
                     "action": "delete_expense",
                     "mode": mode,
-                    "deleted": deleted,
+                    "deleted": len(ids),
                     "ids": ids[:200],
                     "matched": len(ids)
                 })
@@ -1082,6 +3223,119 @@ def execute_plan(chat_id: int, user_id: int, plan: Dict[str, Any]) -> Dict[str,
     return data
 
 
+# =========================
+# Local responder (ответ по шаблону, без LLM)
+# =========================
+
+# действия, ответ на которые собирается локально; остальные формулирует LLM
+LOCAL_REPLY_ACTIONS = ("add_expense", "set_budget", "delete_expense", "get_history", "get_stats")
+
+
+def render_expense_added(r: Dict[str, Any], icon: str = "✅") -> str:
+    currency = r["currency"]
+    text = f"{icon} Записано: {r['main_category']}/{r['sub_category']} — {r['amount']} {currency} (id={r['id']})"
+    roll = r.get("rollover")
+    if roll:
+        text += f"\n📌 {roll['reason']} Сегодня лимит: {roll['today_limit']} {currency}"
+
+    info = r["budget_info"]
+    if info["daily"]["limit"]:
+        text += f"\nДень: осталось {info['daily']['left']} из {info['daily']['limit']} {currency}"
+        if info["daily"]["warn"]:
+            text += "\n⚠️ В дневном бюджете осталось меньше 10%."
+
+    if info["monthly"]["limit"]:
+        text += f"\nМесяц: осталось {info['monthly']['left']} из {info['monthly']['limit']} {currency}"
+        if info["monthly"]["warn"]:
+            text += "\n⚠️ В месячном бюджете осталось меньше 10%."
+    return text
+
+
+def render_set_budget(r: Dict[str, Any]) -> str:
+    parts = []
+    if r["daily_limit"] is not None:
+        parts.append(f"в день {r['daily_limit']} {r['currency']}")
+    if r["monthly_limit"] is not None:
+        parts.append(f"в месяц {r['monthly_limit']} {r['currency']}")
+    if not parts:
+        return f"Бюджет на {r['main_category']} снят."
+    return f"💰 Бюджет на {r['main_category']}: " + ", ".join(parts) + "."
+
+
+def render_delete(r: Dict[str, Any]) -> str:
+    if not r["deleted"]:
+        return "Не нашла подходящих записей для удаления."
+    return f"Готово. Удалено записей: {r['deleted']}."
+
+
+def render_history(r: Dict[str, Any]) -> str:
+    lines = [f"🗂 История за {r['start_date']} — {r['end_date']}"
+             + (f" (стр. {r['page']})" if r["page"] > 1 else "")]
+    if r["page"] == 1:
+        lines.append(f"Итого: {r['total']} {DEFAULT_CURRENCY}, записей: {r['rows_count']}")
+    if r.get("by_main_sub"):
+        lines.append("По категориям:")
+        for c in r["by_main_sub"][:10]:
+            lines.append(f"• {c['main_category']} / {c['sub_category']}: {c['spent']} {c['currency']}")
+    if not r["rows_preview"]:
+        lines.append("Записей нет.")
+    for e in r["rows_preview"]:
+        note = f" — {e['note']}" if e.get("note") else ""
+        lines.append(f"• {e['spent_date']} {e['main_category']}/{e['sub_category']}: {e['amount']} {e['currency']}{note} (id={e['id']})")
+    if r["has_more"]:
+        # с MENTION_ONLY простое «дальше» боту не придёт, а команда — придёт
+        lines.append("Есть ещё — /more")
+    return "\n".join(lines)
+
+
+def render_stats(r: Dict[str, Any]) -> str:
+    lines = [
+        f"📊 Расходы за {r['start_date']} — {r['end_date']}",
+        f"Итого: {r['total']} {DEFAULT_CURRENCY}",
+    ]
+    top = r["cats"][:8]
+    if top:
+        lines.append("Топ категорий:")
+        for c in top:
+            lines.append(f"• {c['main_category']} / {c['sub_category']}: {c['spent']} {c['currency']}")
+    return "\n".join(lines)
+
+
+def summary_with_turn(summary: Optional[str], user_text: str, reply: str) -> str:
+    """
+    summary после хода, ответ на который собран локально (без LLM-ответчика, который обновляет summary сам):
+    дописываем строку «запрос → первая строка ответа», старые строки срезаются до MAX_SUMMARY_CHARS.
+    """
+    line = f"— {user_text[:120]} → {reply.splitlines()[0][:200]}"
+    text = f"{summary}\n{line}" if summary else line
+    while len(text) > MAX_SUMMARY_CHARS and "\n" in text:
+        text = text.split("\n", 1)[1]
+    return text[-MAX_SUMMARY_CHARS:]
+
+
+def render_results(data: Dict[str, Any]) -> Optional[str]:
+    """Ответ по результатам execute_plan без LLM. None — если есть действие, которое нужно сформулировать."""
+    results = data.get("results") or []
+    if not results:
+        return None
+    parts = []
+    for r in results:
+        act = r.get("action")
+        if act not in LOCAL_REPLY_ACTIONS or r.get("error"):
+            return None
+        if act == "add_expense":
+            parts.append(render_expense_added(r))
+        elif act == "set_budget":
+            parts.append(render_set_budget(r))
+        elif act == "delete_expense":
+            parts.append(render_delete(r))
+        elif act == "get_history":
+            parts.append(render_history(r))
+        elif act == "get_stats":
+            parts.append(render_stats(r))
+    return "\n\n".join(parts)
+
+
 # =========================
 # Monthly report (1st day)
 # =========================
@@ -1104,16 +3358,18 @@ def month_report_text_for_user(chat_id: int, user_id: int) -> Optional[str]:
     return "\n".join(lines)
 
 
-async def monthly_job(context: ContextTypes.DEFAULT_TYPE):
-    if today().day != 1:
-        return
-
+def list_known_chats() -> List[int]:
+    flush_touched_chats()
     with db() as conn, conn.cursor() as cur:
         cur.execute("SELECT chat_id FROM known_chats;")
-        chats = [int(r["chat_id"]) for r in cur.fetchall()]
+        return [int(r["chat_id"]) for r in cur.fetchall()]
 
-    for chat_id in chats:
-        start, end = prev_month_range(today())
+
+def month_reports() -> List[Tuple[int, str]]:
+    """Тексты отчётов за прошлый месяц: [(chat_id, text), ...]. Блокирующая, звать через run_db."""
+    start, end = prev_month_range(today())
+    out: List[Tuple[int, str]] = []
+    for chat_id in list_known_chats():
         with db() as conn, conn.cursor() as cur:
             cur.execute("""
                 SELECT DISTINCT tg_user_id
@@ -1124,12 +3380,20 @@ async def monthly_job(context: ContextTypes.DEFAULT_TYPE):
 
         for uid in users:
             txt = month_report_text_for_user(chat_id, uid)
-            if not txt:
-                continue
-            try:
-                await context.bot.send_message(chat_id=chat_id, text=txt)
-            except Exception as e:
-                logger.error("monthly send failed chat=%s: %s", chat_id, e)
+            if txt:
+                out.append((chat_id, txt))
+    return out
+
+
+async def monthly_job(context: ContextTypes.DEFAULT_TYPE):
+    if today().day != 1:
+        return
+
+    for chat_id, txt in await run_db(month_reports):
+        try:
+            await context.bot.send_message(chat_id=chat_id, text=txt)
+        except Exception as e:
+            logger.error("monthly send failed chat=%s: %s", chat_id, e)
 
 
 # =========================
@@ -1137,7 +3401,7 @@ async def monthly_job(context: ContextTypes.DEFAULT_TYPE):
 # =========================
 
 async def broadcast_update(app: Application):
-    prev = get_meta("version")
+    prev = await run_db(get_meta, "version")
     if prev == BOT_VERSION:
         return
 
@@ -1150,9 +3414,7 @@ async def broadcast_update(app: Application):
             "— подтверждение удаления записей\n"
         )
 
-    with db() as conn, conn.cursor() as cur:
-        cur.execute("SELECT chat_id FROM known_chats;")
-        chats = [int(r["chat_id"]) for r in cur.fetchall()]
+    chats = await run_db(list_known_chats)
 
     for chat_id in chats:
         try:
@@ -1160,7 +3422,7 @@ async def broadcast_update(app: Application):
         except Exception as e:
             logger.error("broadcast failed chat=%s: %s", chat_id, e)
 
-    set_meta("version", BOT_VERSION)
+    await run_db(set_meta, "version", BOT_VERSION)
 
 
 # =========================
@@ -1175,10 +3437,23 @@ WELCOME_TEXT = (
     "— Если данных мало — задам один уточняющий вопрос.\n\n"
     "Перенос дневного бюджета:\n"
     "— если вчера недотратили, остаток переносится и увеличивает лимит сегодня\n"
-    "— если вчера перерасход, уменьшает лимит сегодня\n"
+    "— если вчера перерасход, уменьшает лимит сегодня\n\n"
+    "/undo или /undo 3 — удалить последние записи (с подтверждением)\n"
+    "/more — следующая страница истории\n"
 )
 
 
+def confirm_last_question(rows: List[Dict[str, Any]]) -> str:
+    if len(rows) == 1:
+        r = rows[0]
+        return f"Удалить последнюю запись (id={r['id']}, {r['amount']} {r['currency']} — {r['main_category']}/{r['sub_category']})? Да / Нет"
+    lines = [f"Удалить последние {len(rows)} записей?"]
+    for r in rows:
+        lines.append(f"• id={r['id']}, {r['amount']} {r['currency']} — {r['main_category']}/{r['sub_category']}")
+    lines.append("Да / Нет")
+    return "\n".join(lines)
+
+
 async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     global BOT_USERNAME_CACHE
     if not BOT_USERNAME_CACHE:
@@ -1213,99 +3488,168 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not raw:
         return
 
-    # подтверждение удаления
-    st = get_state(chat_id, user_id)
-    if st and st.get("pending") and st.get("kind") == "confirm_delete":
-        low = raw.lower().strip()
-        if low in ("да", "да.", "yes", "y"):
-            ids = st.get("ids", [])
-            deleted = delete_expenses_by_ids(chat_id, user_id, [int(x) for x in ids])
-            clear_state(chat_id, user_id)
-            reply = f"Готово. Удалено записей: {deleted}."
-            add_history(chat_id, user_id, "assistant", reply)
-            await msg.reply_text(reply)
-            return
-        if low in ("нет", "нет.", "no", "n"):
-            clear_state(chat_id, user_id)
-            reply = "Отменено."
-            add_history(chat_id, user_id, "assistant", reply)
-            await msg.reply_text(reply)
-            return
-        await msg.reply_text("Ответьте, пожалуйста: Да или Нет.")
+    # в БД идём, только если обращаются к боту или ждём от пользователя ответа
+    addressed = should_process(update, bot_username)
+    pending = has_pending_state(chat_id, user_id)
+    if not (addressed or pending):
         return
 
-    if not should_process(update, bot_username):
-        return
+    async with UnitOfWork() as uow:
+        # подтверждение удаления
+        st = await run_db(get_state, chat_id, user_id) if pending else None
+        if st and st.get("pending") and st.get("kind") == "confirm_delete":
+            low = raw.lower().strip()
+            if low in ("да", "да.", "yes", "y"):
+                if st.get("filter"):
+                    deleted = len(await run_db(delete_by_saved_filter, chat_id, user_id, st["filter"], st.get("max_id")))
+                else:
+                    ids = st.get("ids", [])
+                    deleted = await run_db(delete_expenses_by_ids, chat_id, user_id, [int(x) for x in ids])
+                await run_db(clear_state, chat_id, user_id)
+                reply = f"Готово. Удалено записей: {deleted}."
+                await run_db(add_history, chat_id, user_id, "assistant", reply)
+                await uow.checkpoint()
+                await msg.reply_text(reply)
+                return
+            if low in ("нет", "нет.", "no", "n"):
+                await run_db(clear_state, chat_id, user_id)
+                reply = "Отменено."
+                await run_db(add_history, chat_id, user_id, "assistant", reply)
+                await uow.checkpoint()
+                await msg.reply_text(reply)
+                return
+            await uow.checkpoint()
+            await msg.reply_text("Ответьте, пожалуйста: Да или Нет.")
+            return
 
-    user_text = strip_bot_mention(raw, bot_username).strip()
-    add_history(chat_id, user_id, "user", user_text)
+        if not addressed:
+            return
 
-    summary = get_summary(chat_id, user_id)
-    history = get_history(chat_id, user_id, HISTORY_LIMIT)
+        user_text = strip_bot_mention(raw, bot_username).strip()
+        await run_db(add_history, chat_id, user_id, "user", user_text)
 
-    plan = await openai_json(build_context(summary, history, user_text, phase="plan"))
+        # контекст диалога нужен только для вызовов LLM — читаем, когда без них не обойтись
+        summary: Optional[str] = None
+        history: List[Dict[str, str]] = []
 
-    if str(plan.get("type") or "").lower() == "clarify":
-        q = str(plan.get("question") or "Уточните, пожалуйста.").strip()
-        add_history(chat_id, user_id, "assistant", q)
-        await msg.reply_text(q)
-        return
+        engine = "json"
+        t_llm = 0.0
+        plan = fast_parse_expense(user_text) if FAST_PATH else None
+        if plan:
+            fast_path_hit()
+        else:
+            summary = await run_db(get_summary, chat_id, user_id)
+            history = await run_db(get_history, chat_id, user_id, HISTORY_LIMIT)
+            await uow.checkpoint()
+            t0 = time.monotonic()
+            if PLAN_ENGINE == "tools":
+                plan = await openai_tools_plan(summary, history, user_text)
+                engine = "tools" if plan else "fallback"
+            if not plan:
+                plan = await openai_json(build_context(summary, history, user_text, phase="plan"), phase="plan", engine=engine)
+            t_llm = time.monotonic() - t0
+            fast_path_miss(t_llm)
+
+        if plan.get("type") == "reply":
+            # движок tools ответил сразу, без действий
+            reply = plan["reply"]
+            await run_db(add_history, chat_id, user_id, "assistant", reply)
+            if plan.get("new_summary"):
+                await run_db(set_summary, chat_id, user_id, str(plan["new_summary"]).strip())
+            llm_turn(engine, t_llm)
+            await uow.checkpoint()
+            await msg.reply_text(reply)
+            return
 
-    # удаление: если нужно подтверждение — спросим
-    actions = plan.get("actions") or []
-    if isinstance(actions, list):
-        for a in actions:
-            if str(a.get("action") or "") == "delete_expense":
-                mode = str(a.get("mode") or "last")
-                if mode == "filter":
-                    start = parse_ymd(a["start_date"])
-                    end = parse_ymd(a["end_date"])
-                    mc = (a.get("main_category") or None)
-                    sc = (a.get("sub_category") or None)
-                    mc = mc.lower().strip() if isinstance(mc, str) and mc.strip() else None
-                    sc = sc.lower().strip() if isinstance(sc, str) and sc.strip() else None
-                    rows = find_expenses(chat_id, user_id, start, end, main_category=mc, sub_category=sc)
-                    ids = [int(r["id"]) for r in rows]
-                    if len(ids) == 0:
-                        reply = "Не нашла подходящих записей для удаления."
-                        add_history(chat_id, user_id, "assistant", reply)
-                        await msg.reply_text(reply)
-                        return
-                    set_state(chat_id, user_id, {"pending": True, "kind": "confirm_delete", "ids": ids[:200]})
-                    q = f"Найдено {len(ids)} записей. Удалить все? Напишите: Да / Нет"
-                    add_history(chat_id, user_id, "assistant", q)
-                    await msg.reply_text(q)
-                    return
-
-                if mode == "last":
-                    rows = find_expenses(chat_id, user_id, today() - timedelta(days=3650), today())
-                    if not rows:
-                        reply = "Нет записей для удаления."
-                        add_history(chat_id, user_id, "assistant", reply)
-                        await msg.reply_text(reply)
+        if str(plan.get("type") or "").lower() == "clarify":
+            q = str(plan.get("question") or "Уточните, пожалуйста.").strip()
+            await run_db(add_history, chat_id, user_id, "assistant", q)
+            if t_llm:
+                llm_turn(engine, t_llm)
+            await uow.checkpoint()
+            await msg.reply_text(q)
+            return
+
+        # удаление: если нужно подтверждение — спросим
+        actions = plan.get("actions") or []
+        if isinstance(actions, list):
+            for a in actions:
+                if str(a.get("action") or "") == "delete_expense":
+                    mode = str(a.get("mode") or "last")
+                    if mode == "filter":
+                        flt = parse_delete_filter(a)
+                        m = await run_db(
+                            match_expenses, chat_id, user_id, parse_ymd(flt["start_date"]), parse_ymd(flt["end_date"]),
+                            main_category=flt["main_category"], sub_category=flt["sub_category"],
+                        )
+                        if m["count"] == 0:
+                            reply = "Не нашла подходящих записей для удаления."
+                            await run_db(add_history, chat_id, user_id, "assistant", reply)
+                            await uow.checkpoint()
+                            await msg.reply_text(reply)
+                            return
+                        # храним фильтр и снимок (max id), а не список id — удалится всё найденное
+                        await run_db(set_state, chat_id, user_id, {
+                            "pending": True, "kind": "confirm_delete", "filter": flt, "max_id": m["max_id"],
+                        })
+                        q = f"Найдено {m['count']} записей. Удалить все? Напишите: Да / Нет"
+                        await run_db(add_history, chat_id, user_id, "assistant", q)
+                        await uow.checkpoint()
+                        await msg.reply_text(q)
                         return
-                    rid = int(rows[0]["id"])
-                    set_state(chat_id, user_id, {"pending": True, "kind": "confirm_delete", "ids": [rid]})
-                    q = f"Удалить последнюю запись (id={rid}, {rows[0]['amount']} {rows[0]['currency']} — {rows[0]['main_category']}/{rows[0]['sub_category']})? Да / Нет"
-                    add_history(chat_id, user_id, "assistant", q)
-                    await msg.reply_text(q)
-                    return
 
-    data = execute_plan(chat_id, user_id, plan)
+                    if mode == "last":
+                        count = parse_count(a.get("count"), UNDO_MAX)
+                        rows = await run_db(last_expenses, chat_id, user_id, count)
+                        if not rows:
+                            reply = "Нет записей для удаления."
+                            await run_db(add_history, chat_id, user_id, "assistant", reply)
+                            await uow.checkpoint()
+                            await msg.reply_text(reply)
+                            return
+                        ids = [int(r["id"]) for r in rows]
+                        await run_db(set_state, chat_id, user_id, {"pending": True, "kind": "confirm_delete", "ids": ids})
+                        q = confirm_last_question(rows)
+                        await run_db(add_history, chat_id, user_id, "assistant", q)
+                        await uow.checkpoint()
+                        await msg.reply_text(q)
+                        return
 
-    final = await openai_json(build_context(
-        summary,
-        history,
-        user_text + "\n\nDATA:\n" + json.dumps(data, ensure_ascii=False),
-        phase="final"
-    ))
-    reply = str(final.get("reply") or "Готово.").strip()
-    new_summary = str(final.get("new_summary") or summary).strip()
+        data = await run_db(execute_plan, chat_id, user_id, plan)
+
+        # простые результаты — по шаблону; анализ (suggest_savings, get_categories) формулирует LLM
+        reply = render_results(data)
+        if reply is None:
+            if summary is None:
+                summary = await run_db(get_summary, chat_id, user_id)
+                history = await run_db(get_history, chat_id, user_id, HISTORY_LIMIT)
+            await uow.checkpoint()
+            t0 = time.monotonic()
+            final = await openai_tools_finish(plan, data) if engine == "tools" else None
+            if final is None:
+                if engine == "tools":
+                    engine = "fallback"
+                final = await openai_json(build_context(
+                    summary,
+                    history,
+                    user_text + "\n\nDATA:\n" + json.dumps(data, ensure_ascii=False, default=str),
+                    phase="final"
+                ), phase="final", engine=engine)
+            t_llm += time.monotonic() - t0
+            reply = str(final.get("reply") or "Готово.").strip()
+            new_summary = str(final.get("new_summary") or summary).strip()
+        else:
+            if summary is None:
+                summary = await run_db(get_summary, chat_id, user_id)
+            new_summary = summary_with_turn(summary, user_text, reply)
+        await run_db(set_summary, chat_id, user_id, new_summary)
+        if t_llm:
+            llm_turn(engine, t_llm)
 
-    add_history(chat_id, user_id, "assistant", reply)
-    set_summary(chat_id, user_id, new_summary)
+        await run_db(add_history, chat_id, user_id, "assistant", reply)
 
-    await msg.reply_text(reply)
+        await uow.checkpoint()
+        await msg.reply_text(reply)
 
 
 async def on_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1325,63 +3669,157 @@ async def on_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     chat_id = update.effective_chat.id
     user_id = update.effective_user.id
-    touch_chat(chat_id)
+    async with UnitOfWork() as uow:
+        touch_chat(chat_id)
+
+        caption = (msg.caption or "").strip()
+        mentioned = extract_bot_mention(caption, msg.caption_entities, bot_username) if caption else False
+        replied = bool(
+            msg.reply_to_message and msg.reply_to_message.from_user and msg.reply_to_message.from_user.is_bot
+            and (msg.reply_to_message.from_user.username or "").lower() == bot_username.lower()
+        )
 
-    caption = (msg.caption or "").strip()
-    mentioned = extract_bot_mention(caption, msg.caption_entities, bot_username) if caption else False
-    replied = bool(
-        msg.reply_to_message and msg.reply_to_message.from_user and msg.reply_to_message.from_user.is_bot
-        and (msg.reply_to_message.from_user.username or "").lower() == bot_username.lower()
-    )
+        if MENTION_ONLY and not (mentioned or replied):
+            return
 
-    if MENTION_ONLY and not (mentioned or replied):
-        return
+        await uow.checkpoint()
+        photo = msg.photo[-1]
+        file = await photo.get_file()
+        image_bytes = await file.download_as_bytearray()
+
+        parsed = await parse_receipt(bytes(image_bytes))
+        if parsed.get("type") != "expense":
+            await uow.checkpoint()
+            await msg.reply_text("Не удалось надёжно распознать чек. Напишите расход текстом, упомянув меня.")
+            return
+
+        try:
+            amount = Decimal(str(parsed.get("amount")))
+            currency = str(parsed.get("currency") or DEFAULT_CURRENCY).upper().strip()
+            mc = str(parsed.get("main_category") or "other").lower().strip()
+            sc = str(parsed.get("sub_category") or mc).lower().strip()
+            note = str(parsed.get("note") or "").strip()
+        except Exception:
+            await uow.checkpoint()
+            await msg.reply_text("Не удалось корректно распознать чек. Напишите расход текстом.")
+            return
+
+        rid, roll, info = await run_db(record_expense, chat_id, user_id, amount, currency, mc, sc, note)
+
+        text = render_expense_added({
+            "id": rid, "amount": str(amount), "currency": currency, "main_category": mc, "sub_category": sc,
+            "rollover": roll, "budget_info": info,
+        }, icon="🧾")
+
+        await run_db(add_history, chat_id, user_id, "user", "[фото]")
+        await run_db(add_history, chat_id, user_id, "assistant", text)
+        summary = await run_db(get_summary, chat_id, user_id)
+        await run_db(set_summary, chat_id, user_id, summary_with_turn(summary, "[фото чека]", text))
+        await uow.checkpoint()
+        await msg.reply_text(text)
 
-    photo = msg.photo[-1]
-    file = await photo.get_file()
-    image_bytes = await file.download_as_bytearray()
 
-    parsed = await parse_receipt(bytes(image_bytes))
-    if parsed.get("type") != "expense":
-        await msg.reply_text("Не удалось надёжно распознать чек. Напишите расход текстом, упомянув меня.")
+async def more_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/more — следующая страница последнего запроса истории."""
+    msg = update.effective_message
+    if not msg or not update.effective_user:
+        return
+    if not is_group(update) or not allowed_topic(update):
         return
 
-    try:
-        amount = Decimal(str(parsed.get("amount")))
-        currency = str(parsed.get("currency") or DEFAULT_CURRENCY).upper().strip()
-        mc = str(parsed.get("main_category") or "other").lower().strip()
-        sc = str(parsed.get("sub_category") or mc).lower().strip()
-        note = str(parsed.get("note") or "").strip()
-    except Exception:
-        await msg.reply_text("Не удалось корректно распознать чек. Напишите расход текстом.")
+    chat_id = update.effective_chat.id
+    user_id = update.effective_user.id
+    async with UnitOfWork() as uow:
+        touch_chat(chat_id)
+        data = await run_db(execute_plan, chat_id, user_id, {"actions": [{"action": "get_history", "page": "next"}]})
+        r = data["results"][0]
+        reply = "Больше страниц нет — запросите историю заново." if r.get("error") else render_history(r)
+        await run_db(add_history, chat_id, user_id, "assistant", reply)
+        await uow.checkpoint()
+        await msg.reply_text(reply)
+
+
+async def undo_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/undo [K] — удалить последние K записей (по умолчанию 1), с подтверждением."""
+    msg = update.effective_message
+    if not msg or not update.effective_user:
+        return
+    if not is_group(update) or not allowed_topic(update):
         return
 
-    roll = ensure_daily_rollover_for_today(chat_id, user_id, mc, currency, today())
+    try:
+        count = int(context.args[0]) if context.args else 1
+    except ValueError:
+        await msg.reply_text("Формат: /undo или /undo 3")
+        return
+    count = min(max(count, 1), UNDO_MAX)
 
-    rid = add_expense(chat_id, user_id, amount, currency, mc, sc, note)
-    info = calc_left_and_warn(chat_id, user_id, mc, currency, today())
+    chat_id = update.effective_chat.id
+    user_id = update.effective_user.id
+    async with UnitOfWork() as uow:
+        touch_chat(chat_id)
+        rows = await run_db(last_expenses, chat_id, user_id, count)
+        if not rows:
+            await uow.checkpoint()
+            await msg.reply_text("Нет записей для удаления.")
+            return
+        await run_db(set_state, chat_id, user_id, {"pending": True, "kind": "confirm_delete", "ids": [int(r["id"]) for r in rows]})
+        q = confirm_last_question(rows)
+        await run_db(add_history, chat_id, user_id, "assistant", q)
+        await uow.checkpoint()
+        await msg.reply_text(q)
 
-    text = f"🧾 Записано: {mc}/{sc} — {amount} {currency} (id={rid})"
-    if roll:
-        text += f"\n📌 {roll['reason']} Сегодня лимит: {roll['today_limit']} {currency}"
 
-    if info["daily"]["limit"]:
-        text += f"\nДень: осталось {info['daily']['left']} из {info['daily']['limit']} {currency}"
-        if info["daily"]["warn"]:
-            text += "\n⚠️ В дневном бюджете осталось меньше 10%."
+async def health_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    m = DB_POOL.metrics()
+    h = http_metrics()
+    fp = FAST_PATH_STATS
+    lines = [
+        "OK",
+        f"db pool: {m['in_use']}/{m['max']} in use, idle {m['idle']}, peak {m['peak_in_use']}",
+        f"waits {m['waits']} ({m['wait_seconds']}s), timeouts {m['timeouts']}, "
+        f"created {m['created']}, recycled {m['recycled']}, health_failures {m['health_failures']}",
+        f"history prune: runs {PRUNE_STATS['runs']}, deleted {PRUNE_STATS['deleted_total']} "
+        f"(last {PRUNE_STATS['last_deleted']} in {PRUNE_STATS['last_seconds']}s)",
+        f"rollovers: runs {ROLLOVER_STATS['runs']}, last {ROLLOVER_STATS['last_day']} "
+        f"(bulk {ROLLOVER_STATS['last_bulk']}, catch-up {ROLLOVER_STATS['last_catchup']} "
+        f"in {ROLLOVER_STATS['last_seconds']}s), recomputed keys {ROLLOVER_STATS['dirty_keys']} "
+        f"(changed {ROLLOVER_STATS['dirty_changed']}, failed {ROLLOVER_STATS['dirty_failed']})",
+        f"fast path: hits {fp['hits']}, misses {fp['misses']}, "
+        f"hit rate {fp['hits'] / max(fp['hits'] + fp['misses'], 1):.0%}, saved ~{fp['saved_seconds']:.1f}s",
+        *(
+            f"engine {name}: turns {st['turns']}, avg {st['seconds'] / max(st['turns'], 1):.2f}s, "
+            f"calls {st['calls']}, tokens in {st['input_tokens']} (cached {st['cached_tokens']}, "
+            f"{st['cached_tokens'] / max(st['input_tokens'], 1):.0%}) / out {st['output_tokens']}"
+            for name, st in LLM_STATS.items()
+        ),
+        *(
+            [f"last llm call: {c['engine']}/{c['phase']} in {c['input_tokens']} (cached {c['cached_tokens']}) "
+             f"out {c['output_tokens']}, {c['seconds']}s"
+             for c in list(LLM_CALLS)[-1:]]
+        ),
+        f"openai http: requests {h['requests']}, new connections {h['new_connections']}, "
+        f"reused {h['reused']} ({h['reuse_ratio']:.0%}), http2 {h['http2']}, errors {h['errors']}",
+    ]
+    await update.effective_message.reply_text("\n".join(lines))
 
-    if info["monthly"]["limit"]:
-        text += f"\nМесяц: осталось {info['monthly']['left']} из {info['monthly']['limit']} {currency}"
-        if info["monthly"]["warn"]:
-            text += "\n⚠️ В месячном бюджете осталось меньше 10%."
 
-    add_history(chat_id, user_id, "user", "[фото]")
-    add_history(chat_id, user_id, "assistant", text)
-    await msg.reply_text(text)
+async def post_init(app: Application):
+    n = await run_db(load_pending_states)
+    logger.info("pending states loaded: %s", n)
+    start_http_client()
+    await broadcast_update(app)
 
 
-async def health_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.effective_message.reply_text("OK")
+async def post_shutdown(app: Application):
+    await close_http_client()
+    try:
+        await run_db(flush_touched_chats)
+    except Exception as e:
+        logger.warning("known_chats flush on shutdown failed: %s", e)
+    # ожидание незавершённых DB-задач и закрытие соединений — блокирующие, не на event loop
+    await asyncio.to_thread(DB_EXECUTOR.shutdown, wait=True)
+    await asyncio.to_thread(DB_POOL.close_all)
 
 
 def normalize_url(u: str) -> str:
@@ -1398,18 +3836,31 @@ def main():
         raise RuntimeError("Missing TELEGRAM_BOT_TOKEN / DATABASE_URL / PUBLIC_URL")
 
     init_db()
+    DB_POOL.prefill()
+    start_backfills()
 
     app = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
 
     app.add_handler(CommandHandler("start", start_cmd))
     app.add_handler(CommandHandler("health", health_cmd))
+    app.add_handler(CommandHandler("undo", undo_cmd))
+    app.add_handler(CommandHandler("more", more_cmd))
     app.add_handler(MessageHandler(filters.PHOTO, on_photo))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, on_text))
 
     if app.job_queue:
         app.job_queue.run_repeating(monthly_job, interval=24 * 60 * 60, first=30)
-
-    app.post_init = broadcast_update
+        app.job_queue.run_repeating(touch_flush_job, interval=TOUCH_FLUSH_INTERVAL, first=TOUCH_FLUSH_INTERVAL)
+        app.job_queue.run_repeating(history_prune_job, interval=CONVO_PRUNE_INTERVAL, first=120)
+        app.job_queue.run_daily(rollover_job, time=rollover_job_time())
+        # после рестарта — догнать сегодняшний день, если ночной запуск пропущен
+        app.job_queue.run_once(rollover_job, when=90)
+        app.job_queue.run_repeating(rollover_dirty_job, interval=ROLLOVER_DIRTY_INTERVAL, first=150)
+        if EXPENSES_PARTITIONED:
+            app.job_queue.run_repeating(partition_job, interval=24 * 60 * 60, first=60)
+
+    app.post_init = post_init
+    app.post_shutdown = post_shutdown
 
     public_url = normalize_url(PUBLIC_URL)
     app.run_webhook(